@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+# Ragai - (c) Eric Dodémont, 2024.
+
+"""
+Offline benchmark suite of the ingestion and the retrieval, on synthetic corpora of web pages shaped like ours
+({url, metadata, text} JSON items). No network: fake embedder, fake chat model, and a Chroma DB on the local
+filesystem (in a temporary directory). Each corpus size runs in its own process (peak RSS per size).
+
+Measures: ingestion throughput (load_files_and_embed), BM25 build time, startup time of the assistant chain,
+retrieval and chain latencies (p50/p95), and peak RSS. The results are written in a JSON file (one per run)
+to be compared over time.
+
+Run from the root of the repository:
+python -m benchmarks.suite [--sizes 1000,10000,100000] [--queries 100] [--dimensions 256] [--set VECTORDB_MAX_RESULTS=10]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import config.config as config
+
+
+def make_vocabulary(rng: random.Random, size: int) -> list:
+    syllables = ["ba", "ro", "que", "lé", "o", "pol", "d", "rei", "ne", "ma", "rie", "hen", "ri", "ette", "al", "bert", "gra", "vu", "re", "por", "trait", "ka", "steel", "van", "der", "kunst", "mu", "sée", "roi", "ko", "ning"]
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(syllables) for _ in range(rng.randint(1, 4))))
+    return sorted(words)
+
+
+def make_corpus(directory: str, nbr_pages: int, pages_per_file: int = 1000, seed: int = 0) -> tuple:
+    """
+    Write the synthetic web pages in JSON files (like the scraped files). The words follow a Zipf distribution.
+    Returns the paths of the files and a few titles (to build the questions).
+    """
+
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng, 5000)
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    os.makedirs(directory, exist_ok=True)
+
+    paths, titles = [], []
+    for first in range(0, nbr_pages, pages_per_file):
+        pages = []
+        for i in range(first, min(first + pages_per_file, nbr_pages)):
+            title = " ".join(rng.choices(vocabulary, weights, k=rng.randint(3, 6)))
+            text = " ".join(rng.choices(vocabulary, weights, k=rng.randint(150, 400)))
+            pages.append({
+                "url": f"https://commons.wikimedia.org/wiki/File:Synthetic_{i}.jpg",
+                "metadata": {
+                    "og:title": f"File:{title}.jpg",
+                    "og:image": f"https://upload.wikimedia.org/synthetic/{i}.jpg",
+                    "og:description": text[:200],
+                    "og:type": "website",
+                    "og:site_name": "Wikimedia Commons",
+                },
+                "text": f"{title} {text}",
+            })
+            if len(titles) < 1000:
+                titles.append(title)
+        path = os.path.join(directory, f"synthetic_{first // pages_per_file:05d}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(pages, f)
+        paths.append(path)
+
+    return paths, titles
+
+
+def latencies_ms(latencies: list) -> dict:
+    return {
+        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+        "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 2),
+        "max_ms": round(float(np.max(latencies)) * 1000, 2),
+    }
+
+
+def configure(work_directory: str, dimensions: int, overrides: dict) -> None:
+    """
+    Offline configuration, set before the modules are imported (they copy the parameters when imported)
+    """
+
+    config.FAKE_EMBEDDINGS = True
+    config.FAKE_EMBEDDINGS_SIZE = dimensions
+    config.FAKE_LLM = True
+    config.CHROMA_SERVER = False
+    config.CHROMA_PERSIST_DIRECTORY = os.path.join(work_directory, "chromadb")
+    config.BM25_INDEX_PATH = os.path.join(work_directory, "bm25_index", "bm25_index.pkl")
+    config.EMBEDDING_CACHE_PATH = os.path.join(work_directory, "embedding_cache", "embeddings.db")
+    config.LOCAL_VECTOR_INDEX_DIR = os.path.join(work_directory, "vector_index")
+    config.ANSWER_CACHE = False  # Each question goes through the retrieval and the generation
+    config.TRACING = False  # Not measured (can be enabled with --set TRACING=true: the traces are then written in the work directory)
+    config.TRACING_JSONL_PATH = os.path.join(work_directory, "traces", "traces.jsonl")
+    config.TRACING_PROMETHEUS_PATH = os.path.join(work_directory, "traces", "metrics.prom")
+    for name, value in overrides.items():
+        setattr(config, name, value)
+
+
+def run_size(nbr_pages: int, nbr_queries: int, dimensions: int, overrides: dict) -> dict:
+    """
+    Benchmark of one corpus size (in a worker process)
+    """
+
+    work_directory = tempfile.mkdtemp(prefix="ragai-benchmark-")
+    configure(work_directory, dimensions, overrides)
+
+    from modules.assistant_backend import get_current_collection_version, instanciate_ai_assistant_chain, instanciate_retrieval
+    from modules.bm25_index import build_bm25_index
+    from modules.chroma_utils import count_collection, get_vector_db
+    from modules.embedding_cache import get_embedding_model
+    from modules.utils import load_files_and_embed
+
+    results = {"pages": nbr_pages}
+    try:
+        start = time.perf_counter()
+        json_paths, titles = make_corpus(os.path.join(work_directory, "json_files"), nbr_pages)
+        results["corpus_seconds"] = round(time.perf_counter() - start, 2)
+
+        # Ingestion: read, embed, write in the DB, and update the BM25 index
+        start = time.perf_counter()
+        load_files_and_embed(json_paths, [], embed=True)
+        seconds = time.perf_counter() - start
+        vector_db = get_vector_db(get_embedding_model(cache=False))
+        results["ingestion"] = {"seconds": round(seconds, 2), "pages_per_second": round(nbr_pages / seconds, 1), "documents_in_db": count_collection(vector_db)}
+
+        # BM25 index built from the whole collection
+        start = time.perf_counter()
+        build_bm25_index(vector_db)
+        results["bm25_build_seconds"] = round(time.perf_counter() - start, 2)
+
+        # Startup of the assistant (cold: nothing cached in this process)
+        start = time.perf_counter()
+        ai_assistant_chain = instanciate_ai_assistant_chain(config.DEFAULT_MODEL, config.DEFAULT_TEMPERATURE)
+        results["startup_seconds"] = round(time.perf_counter() - start, 2)
+
+        rng = random.Random(1)
+        questions = [" ".join(rng.choice(titles).split()[:3]) for _ in range(nbr_queries)]
+
+        # Retrieval only (hybrid retriever: BM25 and vector search)
+        retriever = instanciate_retrieval(get_current_collection_version())["retriever"]
+        latencies = []
+        for question in questions:
+            start = time.perf_counter()
+            retriever.invoke(question)
+            latencies.append(time.perf_counter() - start)
+        results["retrieval"] = latencies_ms(latencies)
+        results["retrieval_legs"] = retriever.stats()
+
+        # Whole chain (fake model): contextualization, variants, retrieval, packing, generation
+        latencies = []
+        for question in questions:
+            start = time.perf_counter()
+            ai_assistant_chain.invoke({"input": question, "chat_history": []})
+            latencies.append(time.perf_counter() - start)
+        results["chain"] = latencies_ms(latencies)
+
+    finally:
+        results["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)  # Linux: kilobytes
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    return results
+
+
+def parse_overrides(assignments: list) -> dict:
+    """
+    --set NAME=VALUE (VALUE in JSON, else a string): parameters of config.py to benchmark
+    """
+
+    overrides = {}
+    for assignment in assignments:
+        name, value = assignment.split("=", 1)
+        try:
+            overrides[name] = json.loads(value)
+        except ValueError:
+            overrides[name] = value
+    return overrides
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark suite of the ingestion and the retrieval")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Numbers of pages of the synthetic corpora")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--dimensions", type=int, default=256, help="Size of the fake vectors")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="Parameter of config.py to change")
+    parser.add_argument("--output-dir", default="./benchmarks/results")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)  # Internal: run one size in this process
+    args = parser.parse_args()
+    overrides = parse_overrides(args.set)
+
+    if args.worker:
+        results = run_size(args.worker, args.queries, args.dimensions, overrides)
+        print(json.dumps(results))  # Last line of the output, read by the parent process
+        return
+
+    env = {**os.environ, "ANONYMIZED_TELEMETRY": "False"}  # No network (Chroma telemetry)
+    all_results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        print(f"Benchmark: {size} pages...")
+        command = [sys.executable, "-m", "benchmarks.suite", "--worker", str(size), "--queries", str(args.queries), "--dimensions", str(args.dimensions)]
+        for assignment in args.set:
+            command += ["--set", assignment]
+        process = subprocess.run(command, capture_output=True, text=True, env=env)
+        lines = process.stdout.strip().splitlines()
+        try:
+            results = json.loads(lines[-1])
+        except (IndexError, ValueError):
+            results = {"pages": size, "error": process.stderr.strip().splitlines()[-1:] or "no output"}
+        print(json.dumps(results, indent=2))
+        all_results.append(results)
+
+    run = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "queries": args.queries,
+        "dimensions": args.dimensions,
+        "overrides": overrides,
+        "parameters": {name: getattr(config, name) for name in ["VECTORDB_MAX_RESULTS", "BM25_MAX_RESULTS", "RETRIEVAL_MAX_RESULTS", "MMR", "MMR_FETCH_K", "CONTEXT_MAX_TOKENS", "EMBEDDING_BATCH_MAX_DOCUMENTS", "EMBEDDING_MAX_CONCURRENCY", "LOCAL_VECTOR_INDEX"]} | overrides,
+        "results": all_results,
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    path = os.path.join(args.output_dir, f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(run, f, indent=2)
+    print(f"Results: {path}")
+
+
+if __name__ == "__main__":
+    main()
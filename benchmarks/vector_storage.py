@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+# Ragai - (c) Eric Dodémont, 2024.
+
+"""
+Benchmark of the storage modes of the local vector index (dimensions, float32 / float16 / int8, rescoring):
+recall@k against the exact search (all the dimensions, float32), memory of the searched vectors, and latency.
+The queries are vectors of documents of our own corpus (the document itself is excluded from the results).
+
+Run from the root of the repository, after the local index has been exported (LOCAL_VECTOR_INDEX = True):
+python -m benchmarks.vector_storage [--directory ./vector_index/<version>] [--queries 200] [--k 5] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from modules.local_vector_index import LocalVectorIndex
+from config.config import *
+
+
+MODES = [  # (dtype, dimensions, rescore)
+    ("float32", None, False),
+    ("float16", None, False),
+    ("int8", None, False),
+    ("int8", None, True),
+    ("float32", 1024, False),
+    ("float32", 1024, True),
+    ("float32", 512, False),
+    ("float32", 512, True),
+    ("float16", 512, True),
+    ("int8", 512, False),
+    ("int8", 512, True),
+    ("int8", 256, True),
+]
+
+
+def latest_index_directory(directory: str = LOCAL_VECTOR_INDEX_DIR) -> str:
+    directories = [os.path.join(directory, name) for name in os.listdir(directory) if os.path.exists(os.path.join(directory, name, "meta.json"))]
+    if not directories:
+        raise SystemExit(f"No local vector index in {directory}: run the app with LOCAL_VECTOR_INDEX = True first")
+    return max(directories, key=os.path.getmtime)
+
+
+def run_benchmark(directory: str, nbr_queries: int, k: int) -> list:
+    exact = LocalVectorIndex(directory, dtype="float32", dimensions=None, rescore=False)
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(exact), size=min(nbr_queries, len(exact)), replace=False)
+    queries = [np.array(exact.vectors[row]) for row in rows]
+
+    def top_k(index, query, row):
+        return [result for result, score in index.search(query, k + 1) if result != row][:k]
+
+    truths = [set(top_k(exact, query, row)) for query, row in zip(queries, rows)]
+
+    results = []
+    for dtype, dimensions, rescore in MODES:
+        index = LocalVectorIndex(directory, dtype=dtype, dimensions=dimensions, rescore=rescore)
+        latencies, recalls = [], []
+        for query, row, truth in zip(queries, rows, truths):
+            start = time.perf_counter()
+            found = top_k(index, query, row)
+            latencies.append(time.perf_counter() - start)
+            recalls.append(len(truth.intersection(found)) / max(len(truth), 1))
+        results.append({
+            "dtype": dtype,
+            "dimensions": index.search_dimensions,
+            "rescore": index.rescore,
+            f"recall@{k}": round(float(np.mean(recalls)), 4),
+            "memory_mb": round(index.memory_bytes() / 1024 / 1024, 1),
+            "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+            "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 2),
+        })
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the storage modes of the local vector index")
+    parser.add_argument("--directory", help="Directory of an exported index (default: the latest one)")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=VECTORDB_MAX_RESULTS)
+    parser.add_argument("--output", help="Write the results in this JSON file")
+    args = parser.parse_args()
+
+    directory = args.directory or latest_index_directory()
+    results = run_benchmark(directory, args.queries, args.k)
+
+    print(f"Index: {directory}")
+    columns = list(results[0])
+    print(" | ".join(f"{column:>12}" for column in columns))
+    for result in results:
+        print(" | ".join(f"{str(result[column]):>12}" for column in columns))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"directory": directory, "queries": args.queries, "k": args.k, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
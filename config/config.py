@@ -3,6 +3,26 @@
 # Backend (Langchain)
 
 EMBEDDING_MODEL = "text-embedding-3-large"  # Must be a model from OpenAI
+EMBEDDING_DIMENSIONS = None  # None: 3072 dimensions. E.g. 1024: shortened vectors (Matryoshka), 3x smaller in Chroma (all the documents have to be embedded again)
+
+FAKE_EMBEDDINGS = False  # True: use a local fake embedder (deterministic vectors, no network) instead of OpenAI, to test offline
+FAKE_EMBEDDINGS_SIZE = 3072
+FAKE_LLM = False  # True: use a fake chat model (fixed answer, no network) whatever the model chosen, to test offline
+
+EMBEDDING_CACHE_PATH = "./embedding_cache/embeddings.db"  # Vectors of the already embedded pages (local filesystem)
+EMBEDDING_CACHE_MAX_SIZE_MB = 2048  # The least recently used vectors are evicted above this size
+QUERY_EMBEDDING_CACHE_MAX_ENTRIES = 10000  # Vectors of the questions kept in memory (least recently used evicted)
+QUERY_EMBEDDING_CACHE_PERSISTENT = False  # True: the vectors of the questions are also kept in the (persistent) embedding cache
+
+PDF_MAX_WORKERS = None  # Number of processes parsing the PDF files (None: number of CPUs)
+PDF_PAGES_PER_TASK = 50  # The large PDF files are parsed in parallel by ranges of pages
+
+EMBEDDING_BATCH_MAX_TOKENS = 100000  # Max (estimated) number of tokens per embedding request
+EMBEDDING_BATCH_MAX_DOCUMENTS = 500  # Max number of documents per embedding request
+EMBEDDING_MAX_CONCURRENCY = 8  # Max number of embedding requests in flight (halved at each 429 response)
+EMBEDDING_MAX_RETRIES = 6  # Retries of an embedding request after a 429 response
+EMBEDDING_BACKOFF_SECONDS = 2  # First retry delay (doubled at each retry)
+EMBEDDING_BACKOFF_MAX_SECONDS = 60
 
 OPENAI_MODEL = "gpt-4o-2024-05-13"
 ANTHROPIC_MODEL = "claude-3-5-sonnet-20240620"  # "claude-3-opus-20240229"
@@ -22,27 +42,82 @@ DEFAULT_TEMPERATURE = 0.2  # OpenAI: 0-2, Anthropic: 0-1
 
 VECTORDB_MAX_RESULTS = 5
 BM25_MAX_RESULTS = 5
+RETRIEVAL_MAX_RESULTS = 10  # Number of documents given to the LLM after the fusion of the results of all the queries
+RRF_K = 60  # Constant of the reciprocal rank fusion: score = weight / (RRF_K + rank)
+MMR = True  # Diversify the fused results with the maximal marginal relevance (e.g. not 5 pages of the same engraving)
+MMR_FETCH_K = 20  # Results of each retriever (instead of BM25_MAX_RESULTS and VECTORDB_MAX_RESULTS) and fused results (candidates) given to the MMR, which keeps RETRIEVAL_MAX_RESULTS of them
+MMR_LAMBDA = 0.5  # 1: relevance only, 0: diversity only (0.5: default of Langchain)
+CONTEXT_MAX_TOKENS = 6000  # Token budget of the retrieved documents in the prompt (filled in rank order)
+CONTEXT_MAX_TOKENS_PER_DOCUMENT = 1000  # The text of each document is truncated to this number of tokens
+CONTEXT_METADATA_FIELDS = ["og:title", "og:image", "og:description"]  # Metadata of the web pages kept in the prompt (with the url and the text)
+RETRIEVAL_TIMEOUT_SECONDS = 10  # Default deadline of each retriever: a late retriever is ignored
+BM25_TIMEOUT_SECONDS = 5  # Deadline of the BM25 (keyword) retriever (in the app process)
+VECTORDB_TIMEOUT_SECONDS = 10  # Deadline of the vector retriever (embedding of the question and query of the vector DB)
+RETRIEVAL_MAX_WORKERS = 32  # Threads running the retrievers (shared by all the questions)
 
 MAX_MESSAGES_IN_MEMORY = 2
 
+ANSWER_CACHE = True  # Reuse the answer of a previous question with the same meaning (first question of a conversation only)
+ANSWER_CACHE_SIMILARITY_THRESHOLD = 0.95  # Min cosine similarity between the embeddings of the standalone questions
+ANSWER_CACHE_MAX_ENTRIES = 1000  # The least recently used answers are evicted above this number
+ANSWER_CACHE_TTL_SECONDS = 86400
+
 OLLAMA_URL = "http://myvm1.edocloud.be:11434"  # "http://35.209.146.25" / "http://localhost:11434" 
 
 CHROMA_SERVER = True
 CHROMA_SERVER_HOST = "myvm2.edocloud.be"
 CHROMA_SERVER_PORT = "8000"
 CHROMA_COLLECTION_NAME = "bmae"  # Name of the collection in the vector DB
+CHROMA_PERSIST_DIRECTORY = "./chromadb"  # DB on the local filesystem (if CHROMA_SERVER is False)
+
+CHROMA_HTTP_POOL_SIZE = 32  # Max number of connections (kept alive) to the Chroma server, per process
+CHROMA_HTTP_KEEPALIVE_SECONDS = 60
+CHROMA_HTTP_TIMEOUT_SECONDS = 60  # Max duration of a request to the Chroma server
+CHROMA_HTTP_CONNECT_TIMEOUT_SECONDS = 5
+CHROMA_HEALTH_CHECK_SECONDS = 30  # The server is checked (heartbeat) when the client is used, at most once per period
+CHROMA_CONNECT_RETRIES = 3  # Attempts to reconnect to the server (e.g. during a restart)
+COLLECTION_VERSION_CHECK_SECONDS = 60  # Max delay for the assistant to see a new version of the collection (written by another process)
+
+CHROMA_PAGE_SIZE = 1000  # Number of documents read at once when iterating over the collection
+CHROMA_WRITE_BATCH_SIZE = 1000  # Number of documents written (or deleted) at once in the collection
+
+BM25_INDEX_PATH = "./bm25_index/bm25_index.pkl"  # BM25 (keyword) index saved on the local filesystem
+
+LOCAL_VECTOR_INDEX = False  # True: the vectors are searched in a local (memory-mapped) copy of the collection, not on the Chroma server
+LOCAL_VECTOR_INDEX_DIR = "./vector_index"  # One subdirectory per collection version
+LOCAL_VECTOR_INDEX_DTYPE = "float32"  # Storage of the searched vectors: "float32", "float16" (2x smaller) or "int8" (4x smaller)
+LOCAL_VECTOR_INDEX_DIMENSIONS = None  # None: all the dimensions. E.g. 512: search on the first dimensions only (Matryoshka)
+LOCAL_VECTOR_INDEX_RESCORE = True  # Rescore the best candidates with the full precision vectors (if the searched vectors are reduced)
+LOCAL_VECTOR_INDEX_RESCORE_CANDIDATES = 10  # Number of candidates per result to rescore
 
 CONTEXTUALIZE_PROMPT = """Given a chat history and the latest user question which \
 might reference context in the chat history, formulate a standalone question which can be \
 understood without the chat history. Do NOT answer the question, just reformulate it if needed \
 and otherwise return it as is.
 
-Can you also translate the question in French, Dutch, and English.
+Chat History:
+
+{chat_history}"""
+
+# The standalone question is translated in each language (one request for all the languages), and each variant is retrieved
+QUERY_LANGUAGES = ["French", "Dutch", "English"]  # [] to retrieve only the standalone question
+QUERY_MODEL = "gpt-4o-mini"  # Small OpenAI model writing the standalone question and its translations (None: the model of the chat session)
+
+# With a chat history: the standalone question and its translations are written in one request
+REWRITE_PROMPT = """Given a chat history and the latest user question which \
+might reference context in the chat history, formulate a standalone question which can be \
+understood without the chat history. Do NOT answer the question, just reformulate it if needed \
+and otherwise return it as is. Then translate the standalone question in each of these languages: {languages}.
+Only return a JSON object, without any explanation, like this one: {example}
 
 Chat History:
 
 {chat_history}"""
 
+TRANSLATE_PROMPT = """Translate the question in each of these languages: {languages}. If the question is already \
+in one of the languages, return it as is for that language. Only return a JSON object, without any explanation, \
+like this one: {example}"""
+
 # This system prompt is used with the OpenAI model
 SYSTEM_PROMPT = """
 You have to answer in the same language as the question. \
@@ -106,6 +181,31 @@ Chat History:
 {chat_history}
 """
 
+# Tracing
+
+TRACING = True  # Record the duration of each stage of the requests (questions, scraping, ingestion)
+TRACING_JSONL_PATH = "./traces/traces.jsonl"  # One line per request, with its stages
+TRACING_JSONL_MAX_SIZE_MB = 100  # The JSONL file is rotated above this size
+TRACING_JSONL_BACKUPS = 3  # Rotated files kept (traces.jsonl.1 is the most recent one)
+TRACING_PROMETHEUS_PATH = "./traces/metrics.prom"  # Prometheus text format (e.g. for the textfile collector of the node exporter)
+TRACING_MAX_SAMPLES = 1000  # Last durations kept in memory per stage, for the percentiles of the dashboard
+
+# Web scraping
+
+COMMONS_URL = "https://commons.wikimedia.org"  # Can be replaced by a local HTTP server serving test pages
+SCRAPING_MAX_WORKERS = 16  # Max number of pages scraped at once
+SCRAPING_MAX_CONCURRENCY_PER_HOST = 4  # Max number of requests at once to the same web site
+SCRAPING_MAX_RETRIES = 4  # Retries of a category page after a 429 or 5xx response
+SCRAPING_BACKOFF_SECONDS = 2  # First retry delay (doubled at each retry)
+
+COMMONS_CATEGORIES_MEMO_PATH = "./http_cache/commons_categories.json"  # Subcategories of the categories already walked
+COMMONS_CATEGORIES_MEMO_TTL_SECONDS = 7 * 86400
+
+HTTP_CACHE = True  # Keep the scraped pages in a local cache, and only download them again if they changed
+HTTP_CACHE_PATH = "./http_cache/pages.db"
+HTTP_CACHE_TTL_SECONDS = 86400  # Younger pages are not revalidated (no request at all)
+HTTP_CACHE_MAX_SIZE_MB = 2048  # The least recently used pages are evicted above this size
+
 # Frontend (Streamlit)
 
 LOGO_PATH = "./images/image.jpg"
@@ -116,14 +216,17 @@ HELLO_MESSAGE = "Hello! Bonjour! Hallo! 👋"
 NEW_CHAT_MESSAGE = "New chat / Nouvelle conversation / Nieuw gesprek"
 USER_PROMPT = "Enter your question / Entrez votre question / Voer uw vraag in"
 
+STREAM_FLUSH_SECONDS = 0.1  # The streamed answer is rendered at most every STREAM_FLUSH_SECONDS...
+STREAM_FLUSH_MAX_CHARACTERS = 400  # ... or as soon as this number of characters is waiting to be rendered
+
 ABOUT_TEXT = """
 ### About this assistant
 
 This AI (Artificial Intelligence) assistant allows you to ask all kinds of questions regarding art and the Belgian monarchy. To answer, the assistant \
 queries different images databases like BALaT/IRPA (Royal Institute of Artistic Heritage), Belgica/KBR (Royal Library), Europeana/KULeuven (Katholieke Universiteit Leuven), and Wikimedia Commons.
 
-The questions can be in any language, but French and Dutch give the best results. If you don't get a correct answer, try rephrasing the question, or just ask the same question again. The \
-assistant has a memory of the questions and answers session. The questions you ask may therefore refer to previous questions and answers. For \
+The questions can be in any language, but French and Dutch give the best results. If you don't get a correct answer, try rephrasing the question, or just ask the same question again (a new answer \
+is then generated). The assistant has a memory of the questions and answers session. The questions you ask may therefore refer to previous questions and answers. For \
 example: *Who painted that canvas?*
 
 ### Concernant cet assistant
@@ -132,7 +235,7 @@ Cet assistant IA (Intelligence Artificielle) vous permet de poser toutes sortes
 questionne différentes bases de données d'images comme BALaT/IRPA (Institut royal du Patrimoine artistique), Belgica/KBR (Bibliothèque royale), Europeana/KULeuven (Katholieke Universiteit Leuven) et Wikimedia Commons.
 
 Les questions peuvent-être posées en différentes langues, mais le français et le néerlandais donnent les meilleurs résultats. Si vous n'obtenez pas une réponse \
-correcte, essayez de reformuler la question, ou reposez à nouveau la même question. L'assistant possède une mémoire de la session de questions et réponses. \
+correcte, essayez de reformuler la question, ou reposez à nouveau la même question (une nouvelle réponse est alors générée). L'assistant possède une mémoire de la session de questions et réponses. \
 Les questions que vous posez peuvent donc faire référence aux questions et réponses précédentes. Par exemple : *Qui a peint ce tableau ?*
 
 #### Examples of questions you can ask
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+# Ragai - (c) Eric Dodémont, 2024.
+
+"""
+Semantic answer cache: the answers are cached in memory with the embedding of the standalone question.
+A new question close enough to a cached one (cosine similarity above a threshold) gets the cached answer,
+without retrieval and generation. Only the first question of a conversation uses the cache (the next answers
+depend on the chat history), and a question asked again in the same conversation gets a new answer.
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from modules.ingestion import estimate_tokens
+from modules.tracing import record_span, span, start_trace
+from config.config import *
+
+
+class SemanticAnswerCache:
+    """
+    Answers cached by (scope, embedding of the standalone question). The scope is (model, temperature, collection
+    version): an answer is only reused with the same model and temperature, and the same knowledge base.
+    The least recently used answers are evicted above max_entries, and the answers expire after ttl seconds.
+    """
+
+    def __init__(self, threshold: float = ANSWER_CACHE_SIMILARITY_THRESHOLD, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, ttl: float = ANSWER_CACHE_TTL_SECONDS):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # Key -> entry (dictionary), from the least to the most recently used
+        self.next_key = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def lookup(self, scope: tuple, vector: list):
+        """
+        Return the cached entry with the most similar question in the scope, or None if there is none above the threshold
+        """
+
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+
+        with self._lock:
+            now = time.time()
+            for key in [key for key, entry in self.entries.items() if now - entry["created_at"] > self.ttl]:
+                del self.entries[key]
+
+            keys = [key for key, entry in self.entries.items() if entry["scope"] == scope]
+            if keys:
+                # Cosine similarities with all the cached questions of the scope at once (vectors are normalized)
+                similarities = np.stack([self.entries[key]["vector"] for key in keys]) @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self.entries.move_to_end(keys[best])
+                    self.hits += 1
+                    return self.entries[keys[best]]
+
+            self.misses += 1
+            return None
+
+    def store(self, scope: tuple, question: str, vector: list, answer: str, seconds: float) -> None:
+        """
+        Cache the answer of a question (seconds: time taken to answer, to compute the time saved by the next hits)
+        """
+
+        vector = np.asarray(vector, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+
+        with self._lock:
+            self.entries[self.next_key] = {"scope": scope, "question": question, "vector": vector, "answer": answer, "seconds": seconds, "created_at": time.time()}
+            self.next_key += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def evict(self, scope: tuple, vector: list) -> int:
+        """
+        Delete the cached answers of the questions similar to this one in the scope (e.g. the answer was not
+        correct and the question is asked again). Returns the number of deleted answers.
+        """
+
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+
+        with self._lock:
+            keys = [key for key, entry in self.entries.items() if entry["scope"] == scope and float(entry["vector"] @ query) >= self.threshold]
+            for key in keys:
+                del self.entries[key]
+
+        return len(keys)
+
+    def record_saved_time(self, seconds: float) -> None:
+        with self._lock:
+            self.saved_seconds += max(seconds, 0.0)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Statistics of the cache since the start of the app
+        """
+
+        lookups = self.hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "saved_seconds": round(self.saved_seconds, 1),
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+        }
+
+
+answer_cache = SemanticAnswerCache()  # Shared by all the chat sessions
+
+
+def split_answer(answer: str) -> list:
+    """
+    Split a cached answer in small chunks (words with their trailing spaces), to be streamed like a generated answer
+    """
+
+    return re.findall(r"\s*\S+\s*", answer) or [answer]
+
+
+class CachedAssistantChain:
+    """
+    Main chain (AI Assistant) with the semantic answer cache in front of the retrieval and the generation.
+    Steps: contextualize the question (standalone question), look up the cache, and if no answer is cached:
+    retrieve and generate, then cache the answer.
+    The cache is only used without chat history: the answers to the next questions depend on the history (e.g.
+    the images already shown are not shown again).
+    """
+
+    def __init__(self, contextualize_chain, answer_chain, embedding_model, scope: tuple, cache: SemanticAnswerCache = None):
+        self.contextualize_chain = contextualize_chain  # Input: {"input", "chat_history"}, output: {"standalone_question"[, "queries"]}
+        self.answer_chain = answer_chain  # Input: {"input", "chat_history", "standalone_question"[, "queries"]}, streams {"queries", "context", "context_stats"}, then {"answer"} chunks
+        self.embedding_model = embedding_model
+        self.scope = scope
+        self.cache = cache
+
+    def stream(self, inputs: dict, regenerate: bool = False):
+        """
+        Stream the answer: dictionaries with an "answer" key (like the chain of create_retrieval_chain).
+        regenerate: the question is asked again (the previous answer was not correct): the cached answers
+        of the question are deleted, and a new answer is generated.
+        Each question is traced: contextualize, cache lookup, retrieval stages, packing, generation (time to
+        first token, tokens per second).
+        """
+
+        use_cache = self.cache is not None and not inputs.get("chat_history")
+
+        with start_trace("question", model=self.scope[0]) as trace:
+            start = time.time()
+            with span("contextualize") as current:
+                rewritten = self.contextualize_chain.invoke(inputs)
+                standalone_question = rewritten["standalone_question"]
+                current.set(tokens=estimate_tokens(standalone_question), queries=len(rewritten.get("queries", [])))
+
+            vector = None
+            if self.cache is not None and regenerate:
+                vector = self.embedding_model.embed_query(standalone_question)
+                self.cache.evict(self.scope, vector)
+            elif use_cache:
+                with span("answer_cache_lookup") as current:
+                    vector = self.embedding_model.embed_query(standalone_question)
+                    entry = self.cache.lookup(self.scope, vector)
+                    current.set(hit=entry is not None)
+                if entry is not None:
+                    if trace is not None:
+                        trace.set(cache_hit=True)
+                    self.cache.record_saved_time(entry["seconds"] - (time.time() - start))
+                    for answer_chunk in split_answer(entry["answer"]):
+                        yield {"answer": answer_chunk}
+                    return
+
+            answer_chunks = []
+            context_stats = {}
+            generation_start = first_token = None
+            for chunk in self.answer_chain.stream({**inputs, **rewritten}):
+                if "context_stats" in chunk:
+                    # The context is packed: the generation starts
+                    context_stats = chunk["context_stats"]
+                    generation_start = time.time()
+                if chunk.get("answer") is not None:
+                    if first_token is None:
+                        first_token = time.time()
+                    answer_chunks.append(chunk["answer"])
+                yield chunk
+
+            answer = "".join(answer_chunks)
+            if generation_start is not None and first_token is not None:
+                end = time.time()
+                output_tokens = estimate_tokens(answer)
+                record_span("generation.ttft", first_token - generation_start, start=generation_start)
+                record_span(
+                    "generation",
+                    end - generation_start,
+                    start=generation_start,
+                    input_tokens=context_stats.get("tokens_out", 0),
+                    tokens=output_tokens,
+                    tokens_per_second=round(output_tokens / max(end - first_token, 1e-6), 1),
+                )
+                if trace is not None:
+                    trace.set(cache_hit=False, ttft_seconds=round(first_token - start, 4), output_tokens=output_tokens)
+
+            if use_cache and answer:
+                if vector is None:
+                    vector = self.embedding_model.embed_query(standalone_question)
+                self.cache.store(self.scope, standalone_question, vector, answer, time.time() - start)
+
+    def invoke(self, inputs: dict, regenerate: bool = False) -> dict:
+        answer_chunks = [chunk["answer"] for chunk in self.stream(inputs, regenerate=regenerate) if chunk.get("answer") is not None]
+        return {**inputs, "answer": "".join(answer_chunks)}
@@ -12,106 +12,179 @@ __import__('pysqlite3')
 import sys
 sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
 
+import json
 import streamlit as st
-from langchain_community.retrievers import BM25Retriever
-from langchain.retrievers import EnsembleRetriever
-from langchain.chains import create_history_aware_retriever  # To create the retriever chain (predefined chain)
-from langchain.chains import create_retrieval_chain  # To create the main chain (predefined chain)
 from langchain.chains.combine_documents import create_stuff_documents_chain  # To create a predefined chain
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
+from langchain_openai import ChatOpenAI
 from langchain_anthropic import ChatAnthropic
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_google_vertexai import ChatVertexAI
 from langchain_community.chat_models import ChatOllama
+from langchain_core.language_models import FakeListChatModel
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_chroma import Chroma
-import chromadb
-from chromadb.config import Settings
-import os
-
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableBranch, RunnableLambda, RunnablePassthrough
+from operator import itemgetter
+from functools import partial
+
+from modules.bm25_index import BM25IndexRetriever, load_bm25_index
+from modules.context_packing import pack_context
+from modules.chroma_utils import get_collection_version, get_document_vectors, get_vector_db
+from modules.answer_cache import CachedAssistantChain, answer_cache
+from modules.embedding_cache import get_embedding_model
+from modules.local_vector_index import LocalVectorIndexRetriever, load_local_vector_index
+from modules.retrieval import HybridRetriever, diversify, multi_query_retrieve, parse_query_variants
+from modules.tracing import span, traced_runnable
 from config.config import *
 
 
-@st.cache_resource
-def instanciate_ai_assistant_chain(model, temperature):
+@st.cache_data(ttl=COLLECTION_VERSION_CHECK_SECONDS, show_spinner=False)
+def get_current_collection_version():
     """
-    Instantiate retrievers and chains and return the main chain (AI Assistant).
-    Steps: Retrieve and generate.
+    Version of the collection, read on the Chroma server at most every COLLECTION_VERSION_CHECK_SECONDS
+    (cheap: only the metadata of the collection is read)
     """
 
-    try:
+    return get_collection_version(get_vector_db())
 
-        embedding_model = OpenAIEmbeddings(model=EMBEDDING_MODEL)  # 3072 dimensions vectors used to embed the JSON items and the questions
 
-        if CHROMA_SERVER:
+def refresh_collection_version():
+    """
+    To be called after a write in the collection: the retrieval resources of the new version are built
+    at the next question, while the LLMs stay cached
+    """
 
-            # Run the Chroma server (the app and the db can run on different servers)
+    get_current_collection_version.clear()
 
-            chroma_server_password = os.getenv("CHROMA_SERVER_AUTHN_CREDENTIALS", "YYYY")
-            chroma_client = chromadb.HttpClient(host=CHROMA_SERVER_HOST, port=CHROMA_SERVER_PORT, settings=Settings(chroma_client_auth_provider="chromadb.auth.token_authn.TokenAuthClientProvider", chroma_client_auth_credentials=chroma_server_password))
-            #chroma_client = chromadb.HttpClient(host=CHROMA_SERVER_HOST, port=CHROMA_SERVER_PORT)
-            vector_db = Chroma(embedding_function=embedding_model, collection_name=CHROMA_COLLECTION_NAME, client=chroma_client)
 
-        else:
+@st.cache_resource(max_entries=1, show_spinner=False)
+def instanciate_retrieval(collection_version):
+    """
+    Instantiate the embedding model, the DB client and the retrievers. Shared by all the models and temperatures;
+    built again only when the version of the collection changes (only the last version is kept in memory).
+    """
 
-            # Save the DB on the local filesystem (the app has to run on the same server)
+    embedding_model = get_embedding_model(cache=QUERY_EMBEDDING_CACHE_PERSISTENT, query_cache=True)  # 3072 dimensions vectors used to embed the JSON items and the questions
 
-            vector_db = Chroma(embedding_function=embedding_model, collection_name=CHROMA_COLLECTION_NAME, persist_directory="./chromadb")
+    # Shared client (HTTP client for the Chroma server, or DB on the local filesystem)
+    vector_db = get_vector_db(embedding_model)
 
-        docs = vector_db.get()
-        documents = docs["documents"]
+    bm25_index = load_bm25_index(vector_db)  # Loaded from the local filesystem, rebuilt only if stale
 
-    except Exception as e:
-        st.write("Error: Cannot instanciate the DB!")
-        st.write(f"Error: {e}")        
+    # With the MMR, each retriever returns MMR_FETCH_K candidates: the MMR selects from a larger pool
+    vectordb_max_results = MMR_FETCH_K if MMR else VECTORDB_MAX_RESULTS
+    bm25_max_results = MMR_FETCH_K if MMR else BM25_MAX_RESULTS
 
-    # Instanciate the model
+    if LOCAL_VECTOR_INDEX:
+        # Brute-force search in a local copy of the collection (no HTTP round trip to the Chroma server)
+        vector_retriever = LocalVectorIndexRetriever(vector_db=vector_db, index=load_local_vector_index(vector_db), k=vectordb_max_results)
+    else:
+        vector_retriever = vector_db.as_retriever(search_type="similarity", search_kwargs={"k": vectordb_max_results})
+
+    keyword_retriever = BM25IndexRetriever(index=bm25_index, k=bm25_max_results)
+
+    # BM25 and vector search run concurrently, each with a deadline
+    hybrid_retriever = HybridRetriever(retrievers=[keyword_retriever, vector_retriever], weights=[0.5, 0.5], names=["bm25", "vector"], timeouts=[BM25_TIMEOUT_SECONDS, VECTORDB_TIMEOUT_SECONDS])
+
+    # Vectors of the documents (for the MMR): from the local index if any, else from the Chroma server
+    if LOCAL_VECTOR_INDEX:
+        document_vectors = vector_retriever.get_vectors
+    else:
+        document_vectors = partial(get_document_vectors, vector_db)
+
+    return {"embedding_model": embedding_model, "retriever": hybrid_retriever, "document_vectors": document_vectors}
+
+
+@st.cache_resource(show_spinner=False)
+def instanciate_llm(model, temperature):
+    """
+    Instantiate the model (cheap: no request is sent), once per (model, temperature)
+    """
+
+    if FAKE_LLM:
+        llm = FakeListChatModel(responses=["This is a fake answer (no model called)."])
+    elif model == OLLAMA_MENU:
+        llm = ChatOllama(model=OLLAMA_MODEL, temperature=temperature, base_url=OLLAMA_URL)
+    elif model == ANTHROPIC_MENU:
+        llm = ChatAnthropic(model_name=ANTHROPIC_MODEL, temperature=temperature, max_tokens=4000)
+    elif model == VERTEXAI_MENU:
+        llm = ChatVertexAI(model_name=VERTEXAI_MODEL, temperature=temperature, max_output_tokens=4000)
+    elif model == OPENAI_MENU:
+        llm = ChatOpenAI(model=OPENAI_MODEL, temperature=temperature)
+    elif model == GOOGLE_MENU:
+        llm = ChatGoogleGenerativeAI(model=GOOGLE_MODEL, temperature=temperature)
+    else:
+        st.write("Error: No model available!")
+        quit()
+
+    return llm
+
+
+@st.cache_resource(show_spinner=False)
+def instanciate_query_llm():
+    """
+    Instantiate the small model writing the standalone question and its translations (shared by all the sessions)
+    """
+
+    if FAKE_LLM:
+        return FakeListChatModel(responses=['{"standalone_question": ""}'])  # The question is kept as is
+
+    return ChatOpenAI(model=QUERY_MODEL, temperature=0)
+
+
+def instanciate_ai_assistant_chain(model, temperature):
+    """
+    Instantiate retrievers and chains and return the main chain (AI Assistant).
+    Steps: Retrieve and generate.
+    The retrieval resources and the model are cached separately: the chains themselves are cheap to build.
+    """
 
     try:
 
-        if model == OLLAMA_MENU:
-            llm = ChatOllama(model=OLLAMA_MODEL, temperature=temperature, base_url=OLLAMA_URL)
-        elif model == ANTHROPIC_MENU:
-            llm = ChatAnthropic(model_name=ANTHROPIC_MODEL, temperature=temperature, max_tokens=4000)
-        elif model == VERTEXAI_MENU:
-            llm = ChatVertexAI(model_name=VERTEXAI_MODEL, temperature=temperature, max_output_tokens=4000)
-        elif model == OPENAI_MENU:
-            llm = ChatOpenAI(model=OPENAI_MODEL, temperature=temperature)
-        elif model == GOOGLE_MENU:
-            llm = ChatGoogleGenerativeAI(model=GOOGLE_MODEL, temperature=temperature)
-        else:
-            st.write("Error: No model available!")
-            quit()
+        collection_version = get_current_collection_version()
+        retrieval = instanciate_retrieval(collection_version)
+        embedding_model = retrieval["embedding_model"]
+        hybrid_retriever = retrieval["retriever"]
+        document_vectors = retrieval["document_vectors"]
 
     except Exception as e:
-        st.write("Error: Cannot instanciate any model!")
+        st.write("Error: Cannot instanciate the DB and the retrievers! Is the DB available?")
         st.write(f"Error: {e}")
+        return None
 
-    # Instanciate the retrievers
+    # Instanciate the model
 
     try:
 
-        vector_retriever = vector_db.as_retriever(search_type="similarity", search_kwargs={"k": VECTORDB_MAX_RESULTS})
-
-        keyword_retriever = BM25Retriever.from_texts(documents)
-        keyword_retriever.k = BM25_MAX_RESULTS
-
-        ensemble_retriever = EnsembleRetriever(retrievers=[keyword_retriever, vector_retriever], weights=[0.5, 0.5])
+        llm = instanciate_llm(model, temperature)
+        query_llm = instanciate_query_llm() if QUERY_MODEL else llm
 
     except Exception as e:
-        st.write("Error: Cannot instanciate the retrievers! Is the DB available?")
+        st.write("Error: Cannot instanciate any model!")
         st.write(f"Error: {e}")
+        return None
 
     # Define the prompts
 
     contextualize_q_system_prompt = CONTEXTUALIZE_PROMPT
 
-    contextualize_q_prompt = ChatPromptTemplate.from_messages(
+    # With a chat history: the standalone question and its translations in one request
+    languages = ", ".join(QUERY_LANGUAGES)
+    rewrite_prompt = ChatPromptTemplate.from_messages(
         [
-            ("system", contextualize_q_system_prompt),
+            ("system", REWRITE_PROMPT if QUERY_LANGUAGES else contextualize_q_system_prompt),
             ("human", "Question: {input}"),
         ]
     )
+    if QUERY_LANGUAGES:
+        rewrite_prompt = rewrite_prompt.partial(languages=languages, example=json.dumps({"standalone_question": "...", **{language: "..." for language in QUERY_LANGUAGES}}))
+
+    translate_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", TRANSLATE_PROMPT),
+            ("human", "Question: {question}"),
+        ]
+    ).partial(languages=languages, example=json.dumps({language: "..." for language in QUERY_LANGUAGES}))
 
     if model == OPENAI_MENU:
         qa_system_prompt = SYSTEM_PROMPT
@@ -129,9 +202,51 @@ def instanciate_ai_assistant_chain(model, temperature):
 
     try:
 
-        history_aware_retriever_chain = create_history_aware_retriever(llm, ensemble_retriever, contextualize_q_prompt)
+        # Standalone question: the question itself if there is no chat history, else reformulated (with its
+        # translations, in the same request) by the query model. Output: {"standalone_question"[, "queries"]}
+        contextualize_chain = RunnableBranch(
+            (lambda x: not x.get("chat_history", False), RunnableLambda(lambda x: {"standalone_question": x["input"]})),
+            RunnablePassthrough.assign(output=rewrite_prompt | query_llm | StrOutputParser()) | RunnableLambda(lambda x: parse_query_variants(x["output"], x["input"])),
+        )
+
+        # Language variants of the standalone question (if not written with it): all the languages in one request
+        def translated_queries(inputs):
+            variants = parse_query_variants(inputs["translations"], inputs["standalone_question"])
+            return list(dict.fromkeys([inputs["standalone_question"]] + variants["queries"]))
+
+        translate_chain = {"question": itemgetter("standalone_question")} | translate_prompt | query_llm | StrOutputParser()
+        query_variants_chain = RunnableBranch(
+            (lambda x: "queries" in x, itemgetter("queries")),
+            (lambda x: not QUERY_LANGUAGES, lambda x: [x["standalone_question"]]),
+            RunnablePassthrough.assign(translations=translate_chain) | RunnableLambda(translated_queries),
+        )
+        query_variants_chain = traced_runnable("query_variants", query_variants_chain)
+
+        # Each variant is retrieved concurrently, the results are fused (RRF), then diversified (MMR)
+        def retrieve(inputs):
+            with span("retrieval", queries=len(inputs["queries"])) as current:
+                candidates = multi_query_retrieve(hybrid_retriever, inputs["queries"], max_results=MMR_FETCH_K if MMR else RETRIEVAL_MAX_RESULTS)
+                current.set(documents=len(candidates))
+            if not MMR:
+                return candidates
+            # More candidates, diversified with the MMR (the vector of the standalone question is in the query embedding cache)
+            query_vector = embedding_model.embed_query(inputs["standalone_question"])
+            with span("mmr", candidates=len(candidates)):
+                return diversify(candidates, query_vector, document_vectors)
+
+        retrieval_chain = RunnableLambda(retrieve)
+
         question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
-        ai_assistant_chain = create_retrieval_chain(history_aware_retriever_chain, question_answer_chain)
+        # The retrieved documents are deduplicated, trimmed and packed in the token budget before the generation
+        answer_chain = (
+            RunnablePassthrough.assign(queries=query_variants_chain).assign(context=retrieval_chain)
+            | RunnableLambda(pack_context)
+            | RunnablePassthrough.assign(answer=question_answer_chain)
+        )
+
+        # The semantic answer cache is in front of the retrieval and the generation
+        scope = (model, temperature, collection_version)
+        ai_assistant_chain = CachedAssistantChain(contextualize_chain, answer_chain, embedding_model, scope, cache=answer_cache if ANSWER_CACHE else None)
 
     except Exception as e:
         st.write("Error: Cannot instanciate the chains!")
@@ -10,6 +10,7 @@ import streamlit as st
 from langchain.memory import ConversationBufferWindowMemory
 
 from modules.assistant_backend import instanciate_ai_assistant_chain
+from modules.streaming_output import StreamingRenderer
 from config.config import *
 
 
@@ -89,26 +90,29 @@ def assistant_frontend():
 
     # React to user input
     if question := st.chat_input(USER_PROMPT):
+        # A question asked again in the conversation gets a new answer (not the cached one)
+        regenerate = any(message["role"] == "user" and message["content"].strip() == question.strip() for message in st.session_state.messages)
         # Display user message in chat message container
         st.chat_message("user").markdown(question)
         # Add user message to chat history
         st.session_state.messages.append({"role": "user", "content": question})
 
+        # The chunks of the answer are rendered on a time/size cadence, not one by one
+        renderer = StreamingRenderer(st.empty())
+
         try:
 
             # Call the main chain (AI assistant). invoke is replaced by stream to stream the answer.
-            answer_container = st.empty()
-            answer = ""
-            for chunk in ai_assistant_chain.stream({"input": question, "chat_history": st.session_state.chat_history}):
-                answer_chunk = str(chunk.get("answer"))
-                if answer_chunk != "None":  # Because it write NoneNone at the beginning 
-                    answer = answer + answer_chunk
-                    answer_container.write(answer)
+            for chunk in ai_assistant_chain.stream({"input": question, "chat_history": st.session_state.chat_history}, regenerate=regenerate):
+                if chunk.get("answer") is not None:  # The first chunks have no answer (context, etc.)
+                    renderer.write(chunk["answer"])
 
         except Exception as e:
             st.write("Error: Cannot invoke/stream the main chain!")
             st.write(f"Error: {e}")
 
+        answer = renderer.close()  # Also the partial answer after an error
+
         # Add Q/A to chat history for Langchain (chat_history)
         st.session_state.chat_history2.save_context({"input": question}, {"output": answer})
         load_memory = st.session_state.chat_history2.load_memory_variables({})
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+# Ragai - (c) Eric Dodémont, 2024.
+
+"""
+Persistent BM25 (keyword) index. The index is saved on the local filesystem, loaded at startup,
+and updated in place when documents are added to or removed from the Chroma collection.
+"""
+
+import os
+import pickle
+import uuid
+from collections import Counter
+
+import numpy as np
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+
+from modules.chroma_utils import get_collection_version, iter_collection
+from config.config import *
+
+
+def tokenize(text: str) -> list:
+    """
+    Split a text in tokens (same preprocessing as the Langchain BM25Retriever)
+    """
+
+    return text.split()
+
+
+class BM25Index:
+    """
+    Okapi BM25 index (same formula and parameters as rank_bm25.BM25Okapi used by the Langchain BM25Retriever).
+    Documents are identified by their ID in the Chroma collection.
+
+    The postings are stored in a CSR-like inverted index made of NumPy arrays: the postings of the term
+    number t are doc_indices[indptr[t]:indptr[t + 1]] (documents) and term_counts[indptr[t]:indptr[t + 1]]
+    (occurrences in each document). Added documents are kept aside and removed documents are only flagged,
+    until the next compaction (before a search or a save).
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.collection_version = ""  # Version of the collection the index is in sync with
+        self.ids = []  # Document number -> ID
+        self.texts = []  # Document number -> text (None if removed)
+        self.positions = {}  # ID -> document number
+        self.vocabulary = {}  # Term -> term number
+        self.indptr = np.zeros(1, dtype=np.int64)  # Term number -> start of its postings
+        self.doc_indices = np.zeros(0, dtype=np.int32)  # Postings: document numbers
+        self.term_counts = np.zeros(0, dtype=np.float32)  # Postings: number of occurrences of the term in the document
+        self.doc_lengths = np.zeros(0, dtype=np.float32)  # Document number -> length (in tokens)
+        self.idf = np.zeros(0, dtype=np.float64)  # Term number -> inverse document frequency
+        self._pending = []  # Added documents not yet in the CSR arrays: (document number, term numbers, counts)
+        self._pending_lengths = []
+        self._dirty = False
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def add(self, ids: list, texts: list) -> None:
+        """
+        Add (or replace) documents in the index
+        """
+
+        for doc_id, text in zip(ids, texts):
+            if doc_id in self.positions:
+                self.remove([doc_id])
+            term_freq = Counter(tokenize(text))
+            terms = np.fromiter((self.vocabulary.setdefault(term, len(self.vocabulary)) for term in term_freq), dtype=np.int64, count=len(term_freq))
+            counts = np.fromiter(term_freq.values(), dtype=np.float32, count=len(term_freq))
+            doc_number = len(self.ids)
+            self.positions[doc_id] = doc_number
+            self.ids.append(doc_id)
+            self.texts.append(text)
+            self._pending.append((doc_number, terms, counts))
+            self._pending_lengths.append(counts.sum())
+        self._dirty = True
+
+    def remove(self, ids: list) -> None:
+        """
+        Remove documents from the index (unknown IDs are ignored)
+        """
+
+        for doc_id in ids:
+            doc_number = self.positions.pop(doc_id, None)
+            if doc_number is None:
+                continue
+            self.texts[doc_number] = None
+            self._dirty = True
+
+    def get_text(self, doc_id: str) -> str:
+        return self.texts[self.positions[doc_id]]
+
+    def compact(self) -> None:
+        """
+        Merge the added documents into the CSR arrays, drop the removed documents and the unused terms,
+        and compute the idf of the terms. All vectorized (no loop over the postings).
+        """
+
+        if not self._dirty:
+            return
+
+        # All the postings as (term, document, count) triples
+        old_terms = np.repeat(np.arange(len(self.indptr) - 1, dtype=np.int64), np.diff(self.indptr))
+        terms = [old_terms] + [p[1] for p in self._pending]
+        docs = [self.doc_indices.astype(np.int64)] + [np.full(len(p[1]), p[0], dtype=np.int64) for p in self._pending]
+        counts = [self.term_counts] + [p[2] for p in self._pending]
+        terms, docs, counts = np.concatenate(terms), np.concatenate(docs), np.concatenate(counts)
+        doc_lengths = np.concatenate([self.doc_lengths, np.array(self._pending_lengths, dtype=np.float32)])
+
+        # Drop the removed documents and renumber the remaining ones
+        alive = np.array([text is not None for text in self.texts], dtype=bool)
+        keep = alive[docs]
+        terms, docs, counts = terms[keep], docs[keep], counts[keep]
+        new_doc_numbers = np.cumsum(alive) - 1
+        docs = new_doc_numbers[docs]
+        self.ids = [doc_id for doc_id, a in zip(self.ids, alive) if a]
+        self.texts = [text for text in self.texts if text is not None]
+        self.positions = {doc_id: i for i, doc_id in enumerate(self.ids)}
+        self.doc_lengths = doc_lengths[alive]
+
+        # Drop the terms which are not in any document anymore and renumber the remaining ones
+        doc_freqs = np.bincount(terms, minlength=len(self.vocabulary))
+        used = doc_freqs > 0
+        new_term_numbers = np.cumsum(used) - 1
+        if not used.all():
+            self.vocabulary = {term: int(new_term_numbers[t]) for term, t in self.vocabulary.items() if used[t]}
+        terms = new_term_numbers[terms]
+        doc_freqs = doc_freqs[used]
+
+        # Sort the postings by term (then by document) and build the CSR arrays
+        order = np.lexsort((docs, terms))
+        self.doc_indices = docs[order].astype(np.int32)
+        self.term_counts = counts[order]
+        self.indptr = np.zeros(len(doc_freqs) + 1, dtype=np.int64)
+        np.cumsum(doc_freqs, out=self.indptr[1:])
+
+        # Idf. Like rank_bm25, the negative values (terms present in more than half of the documents)
+        # are replaced by epsilon * average idf.
+        nbr_docs = len(self.ids)
+        idf = np.log(nbr_docs - doc_freqs + 0.5) - np.log(doc_freqs + 0.5)
+        if len(idf):
+            idf[idf < 0] = self.epsilon * idf.mean()
+        self.idf = idf
+
+        self._pending = []
+        self._pending_lengths = []
+        self._dirty = False
+
+    def search(self, query: str, k: int) -> list:
+        """
+        Return the k best (ID, score) pairs for the query. Only the postings of the terms of the
+        query are read, and only the documents containing at least one of these terms are scored.
+        """
+
+        self.compact()
+
+        # Repeated terms count several times, as in rank_bm25. Unknown terms have a score of 0.
+        terms = np.array([self.vocabulary[term] for term in tokenize(query) if term in self.vocabulary], dtype=np.int64)
+        if not len(terms) or not len(self.ids):
+            return []
+
+        # Gather the postings of the query terms
+        starts, ends = self.indptr[terms], self.indptr[terms + 1]
+        docs = np.concatenate([self.doc_indices[s:e] for s, e in zip(starts, ends)])
+        tf = np.concatenate([self.term_counts[s:e] for s, e in zip(starts, ends)]).astype(np.float64)
+        idf = np.repeat(self.idf[terms], ends - starts)
+
+        # Score of each posting, summed by document
+        avgdl = self.doc_lengths.sum(dtype=np.float64) / len(self.ids)
+        doc_lengths = self.doc_lengths[docs].astype(np.float64)
+        contributions = idf * (tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * doc_lengths / avgdl)))
+        candidates, inverse = np.unique(docs, return_inverse=True)
+        scores = np.bincount(inverse, weights=contributions)
+
+        # Top k with a partial sort
+        if len(scores) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind="stable")]
+
+        return [(self.ids[candidates[i]], float(scores[i])) for i in best]
+
+    def save(self, path: str) -> None:
+        """
+        Save the index on the local filesystem (atomic: a reader never sees a partially written file)
+        """
+
+        self.compact()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp{uuid.uuid4().hex}"  # Unique: several threads or processes can save the index at once
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        """
+        Load an index saved with save()
+        """
+
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+class BM25IndexRetriever(BaseRetriever):
+    """
+    Langchain retriever on top of a BM25Index (drop-in replacement of the BM25Retriever)
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    index: BM25Index
+    k: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list:
+        return [Document(id=doc_id, page_content=self.index.get_text(doc_id)) for doc_id, score in self.index.search(query, self.k)]
+
+
+def build_bm25_index(vector_db) -> BM25Index:
+    """
+    Build the BM25 index from all the documents in the collection and save it
+    """
+
+    version = get_collection_version(vector_db)
+    index = BM25Index()
+    for page in iter_collection(vector_db, include=("documents",)):
+        index.add(page["ids"], page["documents"])
+    index.collection_version = version
+    index.save(BM25_INDEX_PATH)
+    print(f"BM25 index built: {len(index)} documents (collection version: {version})")
+
+    return index
+
+
+def read_bm25_index():
+    """
+    Read the saved BM25 index. Returns None if there is no (readable) saved index.
+    """
+
+    if os.path.exists(BM25_INDEX_PATH):
+        try:
+            return BM25Index.load(BM25_INDEX_PATH)
+        except Exception as e:
+            print(f"Error: Cannot load the BM25 index: {e}")
+
+    return None
+
+
+def load_bm25_index(vector_db) -> BM25Index:
+    """
+    Load the BM25 index from the local filesystem. Rebuild it if it is missing or if it is
+    not in sync with the collection (stale).
+    """
+
+    index = read_bm25_index()
+
+    if index is None or index.collection_version != get_collection_version(vector_db):
+        index = build_bm25_index(vector_db)
+
+    return index
+
+
+def read_bm25_index_for_update(vector_db):
+    """
+    Return the saved BM25 index if it is in sync with the collection, to be updated in place during a write
+    in the collection. Returns None if it is missing or stale (it will be rebuilt after the write).
+    """
+
+    index = read_bm25_index()
+    if index is not None and index.collection_version != get_collection_version(vector_db):
+        index = None
+
+    return index
+
+
+def save_updated_bm25_index(vector_db, index, new_version: str) -> None:
+    """
+    Save the BM25 index updated during a write in the collection (or rebuild it if it was None)
+    """
+
+    if index is None:
+        build_bm25_index(vector_db)
+        return
+
+    index.collection_version = new_version
+    index.save(BM25_INDEX_PATH)
+    print(f"BM25 index updated: {len(index)} documents (collection version: {new_version})")
+
+
+def delete_bm25_index() -> None:
+    """
+    Delete the saved BM25 index (for example after a reset of the collection)
+    """
+
+    if os.path.exists(BM25_INDEX_PATH):
+        os.remove(BM25_INDEX_PATH)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+# Ragai - (c) Eric Dodémont, 2024.
+
+"""
+Functions to work with the Chroma vector DB collection, and the Chroma client shared by the whole process
+(backend, ingestion, admin).
+"""
+
+# Only to be able to run on Github Codespace
+__import__('pysqlite3')
+import sys
+sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+
+import os
+import threading
+import time
+import uuid
+
+import chromadb
+import httpx
+from chromadb.config import Settings
+from langchain_chroma import Chroma
+
+from config.config import *
+
+
+_client = None  # Chroma client shared by the whole process
+_client_checked_at = 0.0
+_client_lock = threading.Lock()
+
+
+def create_chroma_client():
+    """
+    New Chroma client: HTTP client (connection pool with keep-alive) if CHROMA_SERVER is True,
+    else client of the DB on the local filesystem
+    """
+
+    if not CHROMA_SERVER:
+        return chromadb.PersistentClient(path=CHROMA_PERSIST_DIRECTORY)
+
+    chroma_server_password = os.getenv("CHROMA_SERVER_AUTHN_CREDENTIALS", "YYYY")
+    settings = Settings(
+        chroma_client_auth_provider="chromadb.auth.token_authn.TokenAuthClientProvider",
+        chroma_client_auth_credentials=chroma_server_password,
+        chroma_http_max_connections=CHROMA_HTTP_POOL_SIZE,
+        chroma_http_max_keepalive_connections=CHROMA_HTTP_POOL_SIZE,
+        chroma_http_keepalive_secs=CHROMA_HTTP_KEEPALIVE_SECONDS,
+    )
+    client = chromadb.HttpClient(host=CHROMA_SERVER_HOST, port=CHROMA_SERVER_PORT, settings=settings)
+
+    # The HTTP session of the client has no timeout by default
+    session = getattr(getattr(client, "_server", None), "_session", None)
+    if session is not None:
+        session.timeout = httpx.Timeout(CHROMA_HTTP_TIMEOUT_SECONDS, connect=CHROMA_HTTP_CONNECT_TIMEOUT_SECONDS)
+
+    return client
+
+
+def get_chroma_client():
+    """
+    Return the Chroma client shared by the whole process. At checkout, the server is checked (heartbeat) if it
+    has not been checked for CHROMA_HEALTH_CHECK_SECONDS; if it does not answer (e.g. after "db.sh restart"),
+    a new client is created (new connections), with retries.
+    """
+
+    global _client, _client_checked_at
+
+    with _client_lock:
+        if _client is not None and time.time() - _client_checked_at < CHROMA_HEALTH_CHECK_SECONDS:
+            return _client
+
+        for attempt in range(CHROMA_CONNECT_RETRIES + 1):
+            try:
+                if _client is None:
+                    _client = create_chroma_client()
+                _client.heartbeat()
+                _client_checked_at = time.time()
+                return _client
+            except Exception as e:
+                print(f"Chroma: server not available ({e}), reconnect (attempt {attempt + 1})")
+                if _client is not None:
+                    _client.clear_system_cache()  # Else chromadb gives back the same client (same connections)
+                    _client = None
+                if attempt == CHROMA_CONNECT_RETRIES:
+                    raise
+                time.sleep(min(2 ** attempt, 10))
+
+
+def get_vector_db(embedding_model=None) -> Chroma:
+    """
+    Langchain vector store of the collection, on top of the shared Chroma client
+    (embedding_model is only needed to embed: to search or write)
+    """
+
+    return Chroma(embedding_function=embedding_model, collection_name=CHROMA_COLLECTION_NAME, client=get_chroma_client())
+
+
+VERSION_KEY = "ragai_version"  # Key of the collection version in the metadata of the collection
+
+
+def get_collection_version(vector_db) -> str:
+    """
+    Return the version of the collection (changed each time documents are added or removed).
+    Returns an empty string if the collection has never been versioned (or has been reset).
+    """
+
+    # Read the metadata from the server: the collection object cached by Langchain can be outdated
+    collection = vector_db._client.get_collection(vector_db._collection.name)
+    metadata = collection.metadata or {}
+
+    return metadata.get(VERSION_KEY, "")
+
+
+def bump_collection_version(vector_db) -> str:
+    """
+    Give a new version to the collection and return it. To be called after each write in the collection.
+    """
+
+    version = uuid.uuid4().hex
+
+    collection = vector_db._client.get_collection(vector_db._collection.name)
+    metadata = dict(collection.metadata or {})
+    metadata.pop("hnsw:space", None)  # Chroma refuses to modify the distance function of an existing collection
+    metadata[VERSION_KEY] = version
+    collection.modify(metadata=metadata)
+
+    return version
+
+
+def iter_collection(vector_db, include: tuple = ("documents",), page_size: int = CHROMA_PAGE_SIZE):
+    """
+    Iterate over the collection page by page (bounded memory, one bounded HTTP response per page).
+    Only the fields in include ("documents", "metadatas", "embeddings") are read; the IDs are always read.
+    Yields dictionaries like the one returned by vector_db.get(): {"ids": [...], "documents": [...], ...}
+    """
+
+    offset = 0
+    while True:
+        page = vector_db.get(limit=page_size, offset=offset, include=list(include))
+        nbr_ids = len(page["ids"])
+        if nbr_ids:
+            yield page
+        if nbr_ids < page_size:
+            break
+        offset += nbr_ids
+
+
+def get_document_vectors(vector_db, ids: list) -> dict:
+    """
+    Vectors of the documents stored in the collection (one request): dictionary ID -> vector
+    """
+
+    if not ids:
+        return {}
+    result = vector_db._collection.get(ids=list(dict.fromkeys(ids)), include=["embeddings"])
+
+    return dict(zip(result["ids"], result["embeddings"]))
+
+
+def count_collection(vector_db) -> int:
+    """
+    Number of documents in the collection (counted by the server, no document is read)
+    """
+
+    return vector_db._collection.count()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+# Ragai - (c) Eric Dodémont, 2024.
+
+"""
+Context packing: between the retrieval and the generation, the retrieved documents are deduplicated (by ID
+or URL), trimmed to the fields used by the prompt, and added in rank order until the token budget is full.
+"""
+
+import json
+import threading
+
+from langchain_core.documents import Document
+
+from modules.ingestion import estimate_tokens
+from modules.tracing import span
+from config.config import *
+
+
+def parse_web_page_item(text: str):
+    """
+    Return the JSON item (web page: url, metadata, text) of a document, or None if the document is not a web page
+    """
+
+    if not text.startswith("{"):
+        return None
+    try:
+        item = json.loads(text)
+    except ValueError:
+        return None
+
+    return item if isinstance(item, dict) else None
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Truncate a text to about max_tokens tokens (about 4 characters per token), at a word boundary if possible
+    """
+
+    max_characters = max_tokens * 4
+    if len(text) <= max_characters:
+        return text
+    truncated = text[:max_characters]
+    cut = truncated.rfind(" ")
+    if cut > max_characters // 2:
+        truncated = truncated[:cut]
+
+    return truncated + "..."
+
+
+def trim_document(document: Document, item: dict = None, max_tokens: int = CONTEXT_MAX_TOKENS_PER_DOCUMENT) -> Document:
+    """
+    Keep only the fields of the web page used by the prompt (url, some og: fields, beginning of the text).
+    The other documents (PDF pages) are only truncated.
+    """
+
+    if item is None:
+        return Document(id=document.id, page_content=truncate_to_tokens(document.page_content, max_tokens), metadata=document.metadata)
+
+    metadata = item.get("metadata") or {}
+    trimmed = {"url": item.get("url", "")}
+    if isinstance(metadata, dict):
+        trimmed["metadata"] = {field: metadata[field] for field in CONTEXT_METADATA_FIELDS if metadata.get(field)}
+    trimmed["text"] = truncate_to_tokens(str(item.get("text") or ""), max_tokens)
+
+    # ensure_ascii=False: the accented characters (French, Dutch) are not escaped (fewer tokens)
+    return Document(id=document.id, page_content=json.dumps(trimmed, ensure_ascii=False), metadata=document.metadata)
+
+
+def pack_documents(documents: list, max_tokens: int = CONTEXT_MAX_TOKENS) -> tuple:
+    """
+    Deduplicate, trim and select the documents (in rank order) to fit in max_tokens tokens.
+    Returns the packed documents and the statistics (documents and tokens before and after).
+    """
+
+    stats = {"documents_in": len(documents), "duplicates": 0, "documents_out": 0, "tokens_in": 0, "tokens_out": 0}
+    packed = []
+    seen = set()
+    for document in documents:
+        stats["tokens_in"] += estimate_tokens(document.page_content)
+        item = parse_web_page_item(document.page_content)
+        keys = {document.id} if document.id else set()
+        if item is not None and item.get("url"):
+            keys.add(item["url"])
+        if not keys:
+            keys.add(document.page_content)
+        if keys & seen:
+            stats["duplicates"] += 1
+            continue
+        seen |= keys
+
+        document = trim_document(document, item)
+        tokens = estimate_tokens(document.page_content)
+        if stats["tokens_out"] + tokens > max_tokens:
+            if packed:
+                continue  # Does not fit: a next (smaller) document may fit
+            document = Document(id=document.id, page_content=truncate_to_tokens(document.page_content, max_tokens), metadata=document.metadata)
+            tokens = estimate_tokens(document.page_content)
+        packed.append(document)
+        stats["tokens_out"] += tokens
+
+    stats["documents_out"] = len(packed)
+    stats["tokens_saved"] = stats["tokens_in"] - stats["tokens_out"]
+
+    return packed, stats
+
+
+class ContextPackingStats:
+    """
+    Totals since the start of the app (all the chat sessions)
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self.duplicates = 0
+        self._lock = threading.Lock()
+
+    def record(self, stats: dict) -> None:
+        with self._lock:
+            self.requests += 1
+            self.tokens_in += stats["tokens_in"]
+            self.tokens_out += stats["tokens_out"]
+            self.duplicates += stats["duplicates"]
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "tokens_in": self.tokens_in,
+            "tokens_out": self.tokens_out,
+            "tokens_saved": self.tokens_in - self.tokens_out,
+            "saved_ratio": round(1 - self.tokens_out / self.tokens_in, 3) if self.tokens_in else 0.0,
+            "duplicates": self.duplicates,
+        }
+
+
+context_packing_stats = ContextPackingStats()
+
+
+def pack_context(inputs: dict) -> dict:
+    """
+    Chain step: replace the retrieved documents ("context") by the packed ones, and add "context_stats"
+    (tokens saved by this request)
+    """
+
+    with span("context_packing") as current:
+        documents, stats = pack_documents(inputs["context"])
+        current.set(documents_in=stats["documents_in"], documents_out=stats["documents_out"], tokens_in=stats["tokens_in"], tokens_out=stats["tokens_out"])
+    context_packing_stats.record(stats)
+    print(f"Context: {stats['documents_in']} documents -> {stats['documents_out']}, {stats['tokens_in']} tokens -> {stats['tokens_out']} ({stats['tokens_saved']} saved)")
+
+    return {**inputs, "context": documents, "context_stats": stats}
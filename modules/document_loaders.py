@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+# Ragai - (c) Eric Dodémont, 2024.
+
+"""
+Streaming loaders: the JSON items and the PDF pages are read one at a time and turned into Langchain
+documents (generators), so the whole corpus is never in memory. The PDF files are parsed on a pool of processes.
+"""
+
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from pypdf import PdfReader
+
+from config.config import *
+
+
+def iter_json_items(file_path: str, chunk_size: int = 1 << 16):
+    """
+    Yield the items of a JSON file containing a list (array), one at a time, reading the file by chunks.
+    If the file contains an object, its values are yielded (like the jq schema ".[]").
+    """
+
+    decoder = json.JSONDecoder()
+
+    with open(file_path, "r", encoding="utf-8") as f:
+        buffer = f.read(chunk_size)
+        position = 0
+        eof = not buffer
+
+        def skip(characters):
+            # Skip the characters (whitespaces, separators), reading more of the file if needed
+            nonlocal buffer, position, eof
+            while True:
+                while position < len(buffer) and buffer[position] in characters:
+                    position += 1
+                if position < len(buffer) or eof:
+                    return
+                buffer = f.read(chunk_size)
+                position = 0
+                eof = not buffer
+
+        skip(" \t\r\n\ufeff")
+        if eof:
+            return
+        if buffer[position] != "[":
+            # Not a list: load the whole file
+            data = json.loads(buffer[position:] + f.read())
+            yield from (data.values() if isinstance(data, dict) else [data])
+            return
+        position += 1
+
+        while True:
+            skip(" \t\r\n,")
+            if eof:
+                raise ValueError(f"Unexpected end of the JSON file {file_path}")
+            if buffer[position] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+                # A number can be cut by the end of the buffer (e.g. "2." + "5"): the item is complete
+                # only if it is followed by a separator
+                after = end
+                while after < len(buffer) and buffer[after] in " \t\r\n":
+                    after += 1
+                if (after == len(buffer) and not eof) or (after < len(buffer) and buffer[after] not in ",]"):
+                    raise json.JSONDecodeError("Item may be truncated", buffer, end)
+            except json.JSONDecodeError:
+                # The item is not complete in the buffer: read more of the file
+                more = f.read(chunk_size)
+                if not more:
+                    if eof:
+                        raise
+                    eof = True
+                buffer = buffer[position:] + more
+                position = 0
+                continue
+            yield item
+            position = end
+            if position > chunk_size:
+                buffer = buffer[position:]  # Do not keep the items already read in memory
+                position = 0
+
+
+def iter_json_documents(json_file_paths: list):
+    """
+    Yield one document per JSON item (web page), like the JSONLoader (jq_schema=".[]", text_content=False)
+    """
+
+    for json_file_path in json_file_paths:
+        source = str(Path(json_file_path).resolve())
+        nbr_items = 0
+        for i, item in enumerate(iter_json_items(json_file_path), 1):
+            if isinstance(item, str):
+                text = item
+            elif isinstance(item, (dict, list)):
+                text = json.dumps(item) if item else ""
+            else:
+                text = str(item) if item is not None else ""
+            nbr_items = i
+            yield Document(page_content=text, metadata={"source": source, "seq_num": i})
+        print(f"JSON file: {json_file_path}, Number of web pages: {nbr_items}")
+
+
+def parse_pdf_pages(task: tuple) -> tuple:
+    """
+    Parse a range of pages of a PDF file, in a worker process. The pages are chunked like with
+    PyPDFLoader(...).load_and_split().
+    Input: (path of the PDF file, first page, last page + 1)
+    Output: (documents, pid of the worker, seconds, number of pages)
+    """
+
+    pdf_file_path, first_page, end_page = task
+    start = time.time()
+    reader = PdfReader(pdf_file_path)
+    pages = []
+    for page_number in range(first_page, end_page):
+        text = reader.pages[page_number].extract_text()
+        pages.append(Document(page_content=text, metadata={"source": pdf_file_path, "page": page_number}))
+    documents = RecursiveCharacterTextSplitter().split_documents(pages)
+
+    return documents, os.getpid(), time.time() - start, end_page - first_page
+
+
+def iter_pdf_documents(pdf_file_paths: list, stats: dict = None):
+    """
+    Yield the pages (chunks) of the PDF files. The files (and the large files range of pages by range of pages)
+    are parsed in parallel on a pool of processes; the pages are yielded in the order of the files and pages
+    as soon as they are parsed, so the embedding can start while the next pages are still being parsed.
+    stats (if given) is filled with the number of pages and the seconds of each worker: {pid: {"pages": n, "seconds": s}}
+    """
+
+    # Ranges of pages to parse
+    tasks = []
+    for pdf_file_path in pdf_file_paths:
+        nbr_pages = len(PdfReader(pdf_file_path).pages)
+        print(f"PDF file: {pdf_file_path}, Number of PDF pages: {nbr_pages}")
+        for first_page in range(0, nbr_pages, PDF_PAGES_PER_TASK):
+            tasks.append((pdf_file_path, first_page, min(first_page + PDF_PAGES_PER_TASK, nbr_pages)))
+    if not tasks:
+        return
+
+    nbr_workers = PDF_MAX_WORKERS or os.cpu_count() or 1
+    # No fork: in the (multi-threaded) Streamlit server, a forked worker can deadlock on a lock held by another
+    # thread. The workers only import pypdf, the text splitter and the config.
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    with ProcessPoolExecutor(max_workers=nbr_workers, mp_context=multiprocessing.get_context(start_method)) as executor:
+        # At most 2 tasks per worker are submitted ahead: the memory stays bounded if the consumer is slower
+        tasks = iter(tasks)
+        in_flight = deque(executor.submit(parse_pdf_pages, task) for task in itertools.islice(tasks, 2 * nbr_workers))
+        while in_flight:
+            documents, pid, seconds, nbr_pages = in_flight.popleft().result()
+            task = next(tasks, None)
+            if task is not None:
+                in_flight.append(executor.submit(parse_pdf_pages, task))
+            if stats is not None:
+                worker_stats = stats.setdefault(pid, {"pages": 0, "seconds": 0.0})
+                worker_stats["pages"] += nbr_pages
+                worker_stats["seconds"] += seconds
+            yield from documents
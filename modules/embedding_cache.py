@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+# Ragai - (c) Eric Dodémont, 2024.
+
+"""
+Persistent embedding cache: the vectors of the texts already embedded are stored on the local filesystem
+(SQLite DB) with a key computed from the embedding model and the content of the text, and are reused
+instead of calling the embedding model again. The vectors of the questions are also cached in memory (LRU).
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.embeddings import Embeddings, DeterministicFakeEmbedding
+from langchain_openai import OpenAIEmbeddings
+
+from modules.tracing import span
+from config.config import *
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wrap an embedding model with a persistent cache for the documents (embed_documents).
+    The least recently used vectors are evicted when the size of the cache exceeds max_size_mb.
+    """
+
+    def __init__(self, embedding_model: Embeddings, model_name: str, path: str = EMBEDDING_CACHE_PATH, max_size_mb: float = EMBEDDING_CACHE_MAX_SIZE_MB):
+        self.embedding_model = embedding_model
+        self.model_name = model_name
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)  # In bytes
+        self.hits = 0  # Since the creation of this object
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = None  # Opened when needed
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB, size INTEGER, last_used REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+            self._db.commit()
+        return self._db
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\n{text}".encode("utf-8")).hexdigest()
+
+    def embed_documents(self, texts: list) -> list:
+        """
+        Return the vectors of the texts: from the cache if possible, else from the embedding model
+        (each distinct missing text is embedded only once)
+        """
+
+        keys = [self._key(text) for text in texts]
+
+        # Look up the cache
+        with self._lock:
+            db = self._connection()
+            cached = {}
+            unique_keys = list(set(keys))
+            for i in range(0, len(unique_keys), 500):  # Max number of parameters in a SQLite query
+                chunk = unique_keys[i:i + 500]
+                rows = db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                for key, vector in rows:
+                    cached[key] = np.frombuffer(vector, dtype=np.float32).tolist()
+            if cached:
+                now = time.time()
+                db.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in cached])
+                db.commit()
+
+        # Embed the missing texts (outside of the lock: can be long)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing.setdefault(key, text)
+        if missing:
+            vectors = self.embedding_model.embed_documents(list(missing.values()))
+            new = dict(zip(missing.keys(), vectors))
+            with self._lock:
+                db = self._connection()
+                now = time.time()
+                rows = []
+                for key, vector in new.items():
+                    blob = np.asarray(vector, dtype=np.float32).tobytes()
+                    rows.append((key, blob, len(blob), now))
+                db.executemany("INSERT OR REPLACE INTO embeddings (key, vector, size, last_used) VALUES (?, ?, ?, ?)", rows)
+                db.commit()
+                self._evict()
+            cached.update(new)
+
+        hits = len(texts) - len(missing)
+        with self._lock:
+            self.hits += hits
+            self.misses += len(missing)
+            db = self._connection()
+            db.executemany("INSERT INTO stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", [("hits", hits), ("misses", len(missing))])
+            db.commit()
+
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text: str) -> list:
+        """
+        The questions are not cached here (see CachedQueryEmbeddings)
+        """
+
+        return self.embedding_model.embed_query(text)
+
+    def _evict(self) -> None:
+        """
+        Delete the least recently used vectors until the cache is under 90% of its max size (lock held by the caller)
+        """
+
+        db = self._connection()
+        total_size = db.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+        if total_size <= self.max_size:
+            return
+
+        to_free = total_size - int(0.9 * self.max_size)
+        evicted = []
+        for key, size in db.execute("SELECT key, size FROM embeddings ORDER BY last_used"):
+            if to_free <= 0:
+                break
+            evicted.append((key,))
+            to_free -= size
+        db.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+        db.execute("INSERT INTO stats (name, value) VALUES ('evictions', ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (len(evicted),))
+        db.commit()
+        print(f"Embedding cache: {len(evicted)} vectors evicted")
+
+    def stats(self) -> dict:
+        """
+        Statistics of the cache: since the creation of this object (hits, misses) and since the creation
+        of the cache on the filesystem (total_hits, total_misses, evictions), plus the content of the cache
+        """
+
+        with self._lock:
+            db = self._connection()
+            entries, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM embeddings").fetchone()
+            totals = dict(db.execute("SELECT name, value FROM stats").fetchall())
+
+        total_hits = totals.get("hits", 0)
+        total_misses = totals.get("misses", 0)
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "total_hits": total_hits,
+            "total_misses": total_misses,
+            "hit_ratio": round(total_hits / (total_hits + total_misses), 3) if total_hits + total_misses else 0.0,
+            "evictions": totals.get("evictions", 0),
+            "entries": entries,
+            "size_mb": round(size / 1024 / 1024, 1),
+            "max_size_mb": round(self.max_size / 1024 / 1024, 1),
+        }
+
+
+class QueryEmbeddingCache:
+    """
+    In-process LRU cache of the vectors of the questions, keyed by (embedding model, normalized text)
+    """
+
+    def __init__(self, max_entries: int = QUERY_EMBEDDING_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.vectors = OrderedDict()  # Key -> vector, from the least to the most recently used
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple):
+        with self._lock:
+            vector = self.vectors.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self.vectors.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key: tuple, vector: list) -> None:
+        with self._lock:
+            self.vectors[key] = vector
+            self.vectors.move_to_end(key)
+            while len(self.vectors) > self.max_entries:
+                self.vectors.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "entries": len(self.vectors),
+            "max_entries": self.max_entries,
+        }
+
+
+query_embedding_cache = QueryEmbeddingCache()  # Shared by all the chains (the key includes the model)
+
+
+def normalize_query(text: str) -> str:
+    """
+    Normalized question: Unicode NFC, and whitespaces collapsed
+    """
+
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+    Wrap an embedding model with the in-process LRU cache for the questions (embed_query). If persistent is True,
+    the wrapped model is a CachedEmbeddings and the missing questions also go through its persistent cache.
+    """
+
+    def __init__(self, embedding_model: Embeddings, model_name: str, cache: QueryEmbeddingCache = query_embedding_cache, persistent: bool = False):
+        self.embedding_model = embedding_model
+        self.model_name = model_name
+        self.cache = cache
+        self.persistent = persistent
+
+    def embed_documents(self, texts: list) -> list:
+        return self.embedding_model.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list:
+        with span("embed_query") as current:
+            text = normalize_query(text)
+            key = (self.model_name, text)
+            vector = self.cache.get(key)
+            current.set(cached=vector is not None)
+            if vector is None:
+                if self.persistent:
+                    # embed_documents (cached on disk) gives the same vector as embed_query for OpenAI
+                    vector = self.embedding_model.embed_documents([text])[0]
+                else:
+                    vector = self.embedding_model.embed_query(text)
+                self.cache.put(key, vector)
+        return vector
+
+
+def get_embedding_model(cache: bool = True, query_cache: bool = False) -> Embeddings:
+    """
+    Return the embedding model (OpenAI, or the local fake embedder if FAKE_EMBEDDINGS is True),
+    wrapped with the persistent embedding cache if cache is True, and with the in-process
+    cache of the questions if query_cache is True
+    """
+
+    if FAKE_EMBEDDINGS:
+        # Deterministic vectors computed locally from the text (no network): to test offline
+        embedding_model = DeterministicFakeEmbedding(size=FAKE_EMBEDDINGS_SIZE)
+        model_name = f"fake-{FAKE_EMBEDDINGS_SIZE}"
+    else:
+        if EMBEDDING_DIMENSIONS:
+            # Shortened vectors computed by the model (Matryoshka): the documents have to be embedded again
+            embedding_model = OpenAIEmbeddings(model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS)
+            model_name = f"{EMBEDDING_MODEL}-{EMBEDDING_DIMENSIONS}"
+        else:
+            embedding_model = OpenAIEmbeddings(model=EMBEDDING_MODEL)
+            model_name = EMBEDDING_MODEL
+
+    if cache:
+        embedding_model = CachedEmbeddings(embedding_model, model_name)
+
+    if query_cache:
+        embedding_model = CachedQueryEmbeddings(embedding_model, model_name, persistent=cache)
+
+    return embedding_model
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+# Ragai - (c) Eric Dodémont, 2024.
+
+"""
+Shared HTTP fetch layer for the scrapers, with a persistent cache (SQLite DB on the local filesystem).
+The pages are stored with their ETag and Last-Modified headers. A page younger than the TTL is returned
+from the cache; an older one is revalidated with a conditional request (only downloaded again if changed).
+The listing pages (categories, search results) are always revalidated, to see the pages added since.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config.config import *
+
+
+# Shared HTTP session (connection pool with keep-alive) used by all the scrapers
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=SCRAPING_MAX_WORKERS, pool_maxsize=SCRAPING_MAX_WORKERS))
+session.mount("http://", HTTPAdapter(pool_connections=SCRAPING_MAX_WORKERS, pool_maxsize=SCRAPING_MAX_WORKERS))
+
+
+class CachedResponse:
+    """
+    Response returned by http_get (same attributes as a requests Response for what the scrapers use)
+    """
+
+    def __init__(self, url: str, status_code: int, content: bytes, encoding: str = None, from_cache: bool = False):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.encoding = encoding
+        self.from_cache = from_cache
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+
+class HttpCache:
+    """
+    Persistent HTTP cache with conditional revalidation (304 Not Modified), a TTL, and a max size
+    (the least recently used pages are evicted)
+    """
+
+    def __init__(self, path: str = HTTP_CACHE_PATH, ttl: float = HTTP_CACHE_TTL_SECONDS, max_size_mb: float = HTTP_CACHE_MAX_SIZE_MB):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = int(max_size_mb * 1024 * 1024)  # In bytes
+        self.hits = 0  # Returned from the cache without any request
+        self.revalidations = 0  # Returned from the cache after a 304 response
+        self.misses = 0  # Downloaded
+        self.bytes_downloaded = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        self._db = None  # Opened when needed
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, content BLOB, encoding TEXT, etag TEXT, last_modified TEXT, fetched_at REAL, last_used REAL, size INTEGER)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS pages_last_used ON pages (last_used)")
+            self._db.commit()
+        return self._db
+
+    def get(self, url: str, revalidate: bool = False) -> CachedResponse:
+        """
+        GET the URL through the cache. revalidate: always send a (conditional) request, even if the page
+        is younger than the TTL (for the listing pages)
+        """
+
+        with self._lock:
+            db = self._connection()
+            row = db.execute("SELECT content, encoding, etag, last_modified, fetched_at FROM pages WHERE url = ?", (url,)).fetchone()
+            if row and not revalidate and time.time() - row[4] < self.ttl:
+                db.execute("UPDATE pages SET last_used = ? WHERE url = ?", (time.time(), url))
+                db.commit()
+                self.hits += 1
+                self.bytes_saved += len(row[0])
+                return CachedResponse(url, 200, row[0], row[1], from_cache=True)
+
+        # Conditional request if the page is in the cache (outside of the lock: can be long)
+        headers = {}
+        if row:
+            if row[2]:
+                headers["If-None-Match"] = row[2]
+            if row[3]:
+                headers["If-Modified-Since"] = row[3]
+        response = session.get(url, headers=headers)
+
+        with self._lock:
+            db = self._connection()
+            now = time.time()
+            if response.status_code == 304 and row:
+                db.execute("UPDATE pages SET fetched_at = ?, last_used = ? WHERE url = ?", (now, now, url))
+                db.commit()
+                self.revalidations += 1
+                self.bytes_saved += len(row[0])
+                return CachedResponse(url, 200, row[0], row[1], from_cache=True)
+
+            self.misses += 1
+            self.bytes_downloaded += len(response.content)
+            if response.status_code == 200:
+                db.execute(
+                    "INSERT OR REPLACE INTO pages (url, content, encoding, etag, last_modified, fetched_at, last_used, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (url, response.content, response.encoding, response.headers.get("ETag"), response.headers.get("Last-Modified"), now, now, len(response.content)),
+                )
+                db.commit()
+                self._evict()
+
+        return CachedResponse(url, response.status_code, response.content, response.encoding)
+
+    def _evict(self) -> None:
+        """
+        Delete the least recently used pages until the cache is under 90% of its max size (lock held by the caller)
+        """
+
+        db = self._connection()
+        total_size = db.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        if total_size <= self.max_size:
+            return
+
+        to_free = total_size - int(0.9 * self.max_size)
+        evicted = []
+        for url, size in db.execute("SELECT url, size FROM pages ORDER BY last_used"):
+            if to_free <= 0:
+                break
+            evicted.append((url,))
+            to_free -= size
+        db.executemany("DELETE FROM pages WHERE url = ?", evicted)
+        db.commit()
+
+    def stats(self) -> dict:
+        """
+        Statistics of the cache since the start of the app
+        """
+
+        with self._lock:
+            entries, size = self._connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages").fetchone()
+
+        requests_total = self.hits + self.revalidations + self.misses
+
+        return {
+            "hits": self.hits,
+            "revalidations": self.revalidations,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.revalidations) / requests_total, 3) if requests_total else 0.0,
+            "downloaded_mb": round(self.bytes_downloaded / 1024 / 1024, 1),
+            "saved_mb": round(self.bytes_saved / 1024 / 1024, 1),
+            "entries": entries,
+            "size_mb": round(size / 1024 / 1024, 1),
+        }
+
+
+http_cache = HttpCache()
+
+
+def http_get(url: str, revalidate: bool = False):
+    """
+    GET a URL: through the persistent cache if HTTP_CACHE is True, else directly.
+    revalidate: for the listing pages (categories, search results), which change when pages are added:
+    always checked with a conditional request (If-None-Match / If-Modified-Since), never served from the
+    cache without a request.
+    """
+
+    if HTTP_CACHE:
+        return http_cache.get(url, revalidate=revalidate)
+
+    return session.get(url)
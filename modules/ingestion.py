@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+# Ragai - (c) Eric Dodémont, 2024.
+
+"""
+Ingestion scheduler: embed the documents in token-sized batches with several embedding requests in flight
+(the concurrency adapts to the rate limits of the provider), and write the embedded batches in the Chroma
+collection in parallel with the embedding.
+"""
+
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from modules.tracing import span
+from config.config import *
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough number of tokens of a text (about 4 characters per token)
+    """
+
+    return len(text) // 4 + 1
+
+
+def make_batches(documents, max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS, max_documents: int = EMBEDDING_BATCH_MAX_DOCUMENTS):
+    """
+    Split the (document, ID) pairs in batches of at most max_tokens tokens and max_documents documents.
+    The pairs can come from a generator: they are read only when needed. Yields (documents, ids) pairs.
+    """
+
+    batch_documents, batch_ids, batch_tokens = [], [], 0
+    for document, doc_id in documents:
+        tokens = estimate_tokens(document.page_content)
+        if batch_documents and (batch_tokens + tokens > max_tokens or len(batch_documents) >= max_documents):
+            yield batch_documents, batch_ids
+            batch_documents, batch_ids, batch_tokens = [], [], 0
+        batch_documents.append(document)
+        batch_ids.append(doc_id)
+        batch_tokens += tokens
+    if batch_documents:
+        yield batch_documents, batch_ids
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    """
+    True if the exception is a 429 (Too Many Requests) response of the provider
+    """
+
+    if getattr(e, "status_code", None) == 429 or type(e).__name__ == "RateLimitError":
+        return True
+    response = getattr(e, "response", None)
+    return getattr(response, "status_code", None) == 429
+
+
+class AdaptiveConcurrency:
+    """
+    Number of embedding requests allowed in flight: halved at each 429 response,
+    then increased by one after each series of successful requests (AIMD)
+    """
+
+    def __init__(self, max_limit: int = EMBEDDING_MAX_CONCURRENCY, increase_after: int = 4):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.increase_after = increase_after
+        self._successes = 0
+        self._lock = threading.Lock()
+
+    def success(self) -> None:
+        with self._lock:
+            self._successes += 1
+            if self._successes >= self.increase_after and self.limit < self.max_limit:
+                self.limit += 1
+                self._successes = 0
+
+    def rate_limited(self) -> None:
+        with self._lock:
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
+
+
+def embed_batch(embedding_model, texts: list, concurrency: AdaptiveConcurrency, stats: dict) -> list:
+    """
+    Embed a batch of texts. Retry with exponential backoff (and jitter) after a 429 response.
+    """
+
+    for attempt in range(EMBEDDING_MAX_RETRIES + 1):
+        try:
+            with span("ingestion.embed_batch", documents=len(texts), tokens=sum(estimate_tokens(text) for text in texts)):
+                vectors = embedding_model.embed_documents(texts)
+            concurrency.success()
+            return vectors
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt == EMBEDDING_MAX_RETRIES:
+                raise
+            concurrency.rate_limited()
+            stats["retries"] += 1
+            delay = min(EMBEDDING_BACKOFF_MAX_SECONDS, EMBEDDING_BACKOFF_SECONDS * 2 ** attempt) * (0.5 + random.random())
+            print(f"Embedding: rate limited (429), retry in {delay:.1f}s (concurrency: {concurrency.limit})")
+            time.sleep(delay)
+
+
+def embed_and_write(vector_db, documents, progress_callback=None, written_callback=None) -> dict:
+    """
+    Embed the documents ((document, ID) pairs, from a list or a generator) with the embedding model of the
+    vector DB and write (upsert) them in the collection. The embedding requests run concurrently; a writer
+    thread writes each embedded batch in the collection while the next batches are being embedded.
+    The documents are read from the generator only when a request can be sent, so the memory stays bounded.
+    progress_callback(nbr_written_documents, elapsed_seconds) is called (in the calling thread) after each embedded batch.
+    written_callback(documents, ids) is called (in the writer thread) with each written batch.
+    Returns statistics: documents, batches, retries, seconds, documents per second.
+    """
+
+    embedding_model = vector_db.embeddings
+    concurrency = AdaptiveConcurrency()
+    stats = {"documents": 0, "batches": 0, "retries": 0}
+    start = time.time()
+
+    # Writer thread: writes the embedded batches in the collection (the queue is bounded to bound the memory)
+    write_queue = queue.Queue(maxsize=EMBEDDING_MAX_CONCURRENCY * 2)
+    writer_errors = []
+    written = [0]
+
+    def writer():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            if writer_errors:
+                continue  # Drain the queue after an error
+            batch_documents, batch_ids, vectors = item
+            try:
+                with span("ingestion.upsert", documents=len(batch_ids)):
+                    vector_db._collection.upsert(
+                        ids=batch_ids,
+                        embeddings=vectors,
+                        metadatas=[document.metadata for document in batch_documents],
+                        documents=[document.page_content for document in batch_documents],
+                    )
+                written[0] += len(batch_ids)
+                if written_callback:
+                    written_callback(batch_documents, batch_ids)
+            except Exception as e:
+                writer_errors.append(e)
+
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    writer_thread.start()
+
+    try:
+        with ThreadPoolExecutor(max_workers=EMBEDDING_MAX_CONCURRENCY) as executor:
+            in_flight = {}
+            batches = make_batches(documents)
+            exhausted = False
+            while not exhausted or in_flight:
+                # Keep as many requests in flight as allowed by the (adaptive) concurrency
+                while not exhausted and len(in_flight) < concurrency.limit:
+                    batch = next(batches, None)
+                    if batch is None:
+                        exhausted = True
+                        break
+                    batch_documents, batch_ids = batch
+                    texts = [document.page_content for document in batch_documents]
+                    future = executor.submit(embed_batch, embedding_model, texts, concurrency, stats)
+                    in_flight[future] = batch
+                    stats["batches"] += 1
+                    stats["documents"] += len(batch_ids)
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch_documents, batch_ids = in_flight.pop(future)
+                    write_queue.put((batch_documents, batch_ids, future.result()))  # Blocks if the writer is late
+                if writer_errors:
+                    raise writer_errors[0]
+                if progress_callback:
+                    progress_callback(written[0], time.time() - start)
+    finally:
+        write_queue.put(None)
+        writer_thread.join()
+
+    if writer_errors:
+        raise writer_errors[0]
+
+    if progress_callback:
+        progress_callback(written[0], time.time() - start)
+
+    stats["seconds"] = round(time.time() - start, 1)
+    stats["documents_per_second"] = round(stats["documents"] / max(time.time() - start, 1e-6), 1)
+    stats["final_concurrency"] = concurrency.limit
+
+    return stats
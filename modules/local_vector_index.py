@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+# Ragai - (c) Eric Dodémont, 2024.
+
+"""
+Local vector index: a copy of the Chroma collection on the local filesystem, searched in the app process
+(no HTTP round trip to the Chroma server). The vectors are stored in a float32 matrix which is memory-mapped:
+the Streamlit worker processes share the same pages of the file through the page cache of the OS.
+The index is exported again from the collection when the version of the collection changes.
+To use less memory, the vectors can be searched shortened (Matryoshka) and/or in float16 or int8.
+"""
+
+import json
+import os
+import shutil
+import time
+import uuid
+
+import numpy as np
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+
+from modules.chroma_utils import get_collection_version, iter_collection
+from config.config import *
+
+
+def storage_suffix(dtype: str, dimensions: int) -> str:
+    return f"{dtype}-{dimensions}"
+
+
+class LocalVectorIndex:
+    """
+    Index exported in a directory (one directory per collection version):
+    vectors.f32 (normalized vectors, one row per document), ids.json (ID of each row),
+    documents.jsonl (content and metadata of each row) and offsets.npy (offset of each row in documents.jsonl).
+    The vectors can be searched in a reduced form (first dimensions only, float16 or int8), derived from
+    vectors.f32 when the index is opened; the best candidates are then rescored with the full vectors.
+    """
+
+    def __init__(self, directory: str, dtype: str = LOCAL_VECTOR_INDEX_DTYPE, dimensions: int = LOCAL_VECTOR_INDEX_DIMENSIONS, rescore: bool = LOCAL_VECTOR_INDEX_RESCORE, rescore_candidates: int = LOCAL_VECTOR_INDEX_RESCORE_CANDIDATES):
+        with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.directory = directory
+        self.version = meta["version"]
+        self.dimensions = meta["dimensions"]
+        with open(os.path.join(directory, "ids.json"), "r", encoding="utf-8") as f:
+            self.ids = json.load(f)
+        if self.ids:
+            self.vectors = np.memmap(os.path.join(directory, "vectors.f32"), dtype=np.float32, mode="r", shape=(len(self.ids), self.dimensions))
+        else:
+            self.vectors = np.zeros((0, self.dimensions), dtype=np.float32)
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"))
+        self._documents_fd = os.open(os.path.join(directory, "documents.jsonl"), os.O_RDONLY)
+        self._rows = None  # ID -> row, built when needed
+
+        # Vectors searched: the full ones, or reduced ones
+        self.dtype = dtype
+        self.search_dimensions = min(dimensions or self.dimensions, self.dimensions)
+        self.reduced = dtype != "float32" or self.search_dimensions < self.dimensions
+        self.rescore = rescore and self.reduced
+        self.rescore_candidates = rescore_candidates
+        self.search_vectors = self.vectors
+        self.scales = None  # int8: scale of each row
+        if self.reduced and self.ids:
+            self._open_reduced_vectors()
+
+    def _open_reduced_vectors(self) -> None:
+        """
+        Memory-map the reduced vectors, derived from the full ones (block by block) the first time
+        """
+
+        suffix = storage_suffix(self.dtype, self.search_dimensions)
+        path = os.path.join(self.directory, f"vectors-{suffix}.bin")
+        scales_path = os.path.join(self.directory, f"scales-{suffix}.f32")
+        shape = (len(self.ids), self.search_dimensions)
+
+        if not os.path.exists(path):
+            tmp_suffix = f".tmp{uuid.uuid4().hex}"
+            tmp_path = f"{path}{tmp_suffix}"
+            scales = []
+            with open(tmp_path, "wb") as vectors_file:
+                for first in range(0, len(self.ids), 65536):
+                    # Truncated vectors (Matryoshka) must be normalized again
+                    block = np.array(self.vectors[first:first + 65536, :self.search_dimensions])
+                    block /= np.maximum(np.linalg.norm(block, axis=1, keepdims=True), 1e-12)
+                    if self.dtype == "int8":
+                        # Symmetric quantization, one scale per row
+                        block_scales = np.maximum(np.abs(block).max(axis=1), 1e-12) / 127
+                        block = np.round(block / block_scales[:, None]).astype(np.int8)
+                        scales.append(block_scales.astype(np.float32))
+                    else:
+                        block = block.astype(self.dtype)
+                    vectors_file.write(block.tobytes())
+            if self.dtype == "int8":
+                np.concatenate(scales).tofile(f"{scales_path}{tmp_suffix}")
+                os.replace(f"{scales_path}{tmp_suffix}", scales_path)
+            os.replace(tmp_path, path)  # Last: its presence means that the reduced index is complete
+
+        self.search_vectors = np.memmap(path, dtype=self.dtype, mode="r", shape=shape)
+        if self.dtype == "int8":
+            self.scales = np.fromfile(scales_path, dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __del__(self):
+        os.close(self._documents_fd)
+
+    def memory_bytes(self) -> int:
+        """
+        Size of the searched vectors (the full ones are only read for the rescored candidates)
+        """
+
+        return self.search_vectors.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def _scores(self, query: np.ndarray) -> np.ndarray:
+        """
+        Similarities between the query and all the searched vectors, block by block
+        (float16 and int8 blocks are converted to float32: the whole matrix is never converted at once)
+        """
+
+        if not self.reduced:
+            return self.vectors @ query
+
+        query = query[:self.search_dimensions].copy()
+        query /= np.linalg.norm(query) or 1.0
+        scores = np.empty(len(self.ids), dtype=np.float32)
+        for first in range(0, len(self.ids), 65536):
+            scores[first:first + 65536] = self.search_vectors[first:first + 65536].astype(np.float32) @ query
+        if self.scales is not None:
+            scores *= self.scales
+
+        return scores
+
+    def search(self, vector: list, k: int) -> list:
+        """
+        Return the k most similar rows: [(row, cosine similarity), ...] sorted by decreasing similarity (brute force)
+        """
+
+        if not len(self.ids):
+            return []
+
+        query = np.array(vector, dtype=np.float32)  # Copy: normalized in place
+        query /= np.linalg.norm(query) or 1.0
+        scores = self._scores(query)
+        nbr_candidates = min(k * self.rescore_candidates if self.rescore else k, len(scores))
+        top = np.argpartition(-scores, nbr_candidates - 1)[:nbr_candidates]
+
+        if self.rescore:
+            # Full precision similarities of the candidates only
+            top = np.sort(top)  # Rows read in the order of the file
+            scores = dict(zip(top.tolist(), (self.vectors[top] @ query).tolist()))
+            top = sorted(scores, key=scores.get, reverse=True)[:k]
+            return [(int(row), float(scores[row])) for row in top]
+
+        top = top[np.argsort(-scores[top])][:k]
+
+        return [(int(row), float(scores[row])) for row in top]
+
+    def get_vectors(self, ids: list) -> dict:
+        """
+        Full vectors of the documents: dictionary ID -> vector
+        """
+
+        if self._rows is None:
+            self._rows = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        rows = {doc_id: self._rows[doc_id] for doc_id in ids if doc_id in self._rows}
+
+        return {doc_id: np.array(self.vectors[row]) for doc_id, row in rows.items()}
+
+    def get_document(self, row: int) -> Document:
+        """
+        Read the document of a row (os.pread: safe to call from several threads)
+        """
+
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        record = json.loads(os.pread(self._documents_fd, end - start, start).decode("utf-8"))
+
+        return Document(id=self.ids[row], page_content=record["document"] or "", metadata=record["metadata"] or {})
+
+
+def export_local_vector_index(vector_db, directory: str = LOCAL_VECTOR_INDEX_DIR) -> str:
+    """
+    Export the collection (vectors, IDs, documents and metadatas) in a new directory of the local index,
+    page by page (bounded memory). Returns the directory.
+    """
+
+    version = get_collection_version(vector_db)
+    final_directory = os.path.join(directory, version or "unversioned")
+    tmp_directory = f"{final_directory}.tmp{uuid.uuid4().hex}"  # Unique: two threads or processes can export the same version
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+
+    start = time.time()
+    ids = []
+    offsets = [0]
+    dimensions = 0
+    with open(os.path.join(tmp_directory, "vectors.f32"), "wb") as vectors_file, open(os.path.join(tmp_directory, "documents.jsonl"), "wb") as documents_file:
+        for page in iter_collection(vector_db, include=("documents", "metadatas", "embeddings")):
+            vectors = np.asarray(page["embeddings"], dtype=np.float32)
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            dimensions = vectors.shape[1]
+            vectors_file.write(vectors.tobytes())
+            for document, metadata in zip(page["documents"], page["metadatas"]):
+                line = (json.dumps({"document": document, "metadata": metadata}) + "\n").encode("utf-8")
+                documents_file.write(line)
+                offsets.append(offsets[-1] + len(line))
+            ids.extend(page["ids"])
+
+    with open(os.path.join(tmp_directory, "ids.json"), "w", encoding="utf-8") as f:
+        json.dump(ids, f)
+    np.save(os.path.join(tmp_directory, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    with open(os.path.join(tmp_directory, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"version": version, "dimensions": dimensions, "count": len(ids)}, f)
+
+    try:
+        os.rename(tmp_directory, final_directory)  # Atomic: the other processes never see a partial index
+    except OSError:
+        shutil.rmtree(tmp_directory, ignore_errors=True)  # Already exported by another process
+
+    print(f"Local vector index exported: {len(ids)} documents, {dimensions} dimensions (collection version: {version}) in {time.time() - start:.1f}s")
+
+    return final_directory
+
+
+def delete_old_local_vector_indexes(current_directory: str = None, directory: str = LOCAL_VECTOR_INDEX_DIR) -> None:
+    """
+    Delete the indexes of the previous versions, or all the indexes if current_directory is None (e.g. after a
+    reset of the collection). A process still using one keeps its memory-mapped files until it closes them.
+    """
+
+    if not os.path.isdir(directory):
+        return
+
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if path != current_directory and ".tmp" not in name:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def load_local_vector_index(vector_db, directory: str = LOCAL_VECTOR_INDEX_DIR) -> LocalVectorIndex:
+    """
+    Open the local index of the current version of the collection, exported first if needed
+    """
+
+    version = get_collection_version(vector_db)
+    version_directory = os.path.join(directory, version or "unversioned")
+    if not os.path.exists(os.path.join(version_directory, "meta.json")):
+        version_directory = export_local_vector_index(vector_db, directory)
+        delete_old_local_vector_indexes(version_directory, directory)
+
+    return LocalVectorIndex(version_directory)
+
+
+class LocalVectorIndexRetriever(BaseRetriever):
+    """
+    Langchain retriever on top of the local vector index (replacement of vector_db.as_retriever()).
+    The retriever is built for one version of the collection (see instanciate_retrieval, cached per version).
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    vector_db: object
+    index: LocalVectorIndex
+    k: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list:
+        vector = self.vector_db.embeddings.embed_query(query)
+
+        return [self.index.get_document(row) for row, score in self.index.search(vector, self.k)]
+
+    def get_vectors(self, ids: list) -> dict:
+        return self.index.get_vectors(ids)
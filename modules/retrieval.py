@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+# Ragai - (c) Eric Dodémont, 2024.
+
+"""
+Retrieval helpers: the question is retrieved in several languages (one query per language variant, run
+concurrently), and the ranked lists of documents are fused with the reciprocal rank fusion (RRF).
+The hybrid retriever runs the keyword (BM25) and vector retrievers concurrently, each with a deadline.
+The fused results can be diversified with the maximal marginal relevance (MMR).
+"""
+
+import contextvars
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict, PrivateAttr
+
+from modules.tracing import span
+from config.config import *
+
+
+def document_key(document: Document) -> str:
+    """
+    Key used to deduplicate the documents: the ID of the document in the vector DB, else its content
+    """
+
+    return document.id or document.page_content
+
+
+def reciprocal_rank_fusion(rankings: list, weights: list = None, k: int = RRF_K) -> list:
+    """
+    Fuse ranked lists of documents: the score of a document is the sum over the lists of weight / (k + rank).
+    The documents are deduplicated by ID. Returns the documents sorted by decreasing score.
+    """
+
+    if weights is None:
+        weights = [1.0] * len(rankings)
+
+    scores = {}
+    documents = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, document in enumerate(ranking, 1):
+            key = document_key(document)
+            scores[key] = scores.get(key, 0.0) + weight / (k + rank)
+            if key not in documents or not documents[key].metadata:
+                documents[key] = document  # The BM25 retriever returns the documents without metadata
+
+    return [documents[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+
+# Shared by all the hybrid retrievers. Not used as a context manager: a retriever which misses its
+# deadline is not waited for, it finishes in the background.
+retrieval_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_MAX_WORKERS, thread_name_prefix="retrieval")
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Run several retrievers concurrently and fuse their results with the weighted RRF (replacement of the
+    EnsembleRetriever, which runs them one after the other). A retriever which does not answer within its
+    timeout (timeouts: one per retriever, else timeout for all) is ignored: the results of the other ones are returned.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    retrievers: list
+    weights: list = None
+    names: list = None
+    timeout: float = RETRIEVAL_TIMEOUT_SECONDS
+    timeouts: list = None
+    _stats: dict = PrivateAttr(default_factory=dict)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list:
+        names = self.names or [type(retriever).__name__ for retriever in self.retrievers]
+        weights = self.weights or [1.0] * len(self.retrievers)
+        timeouts = self.timeouts or [self.timeout] * len(self.retrievers)
+
+        def timed_retrieve(name, retriever):
+            start = time.time()
+            with span(f"retrieval.{name}") as current:
+                documents = retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+                current.set(documents=len(documents))
+            return documents, time.time() - start
+
+        start = time.time()
+        # Copied context: the spans of the retrievers are recorded in the trace of the request
+        futures = [retrieval_executor.submit(contextvars.copy_context().run, timed_retrieve, name, retriever) for name, retriever in zip(names, self.retrievers)]
+
+        rankings, ranking_weights = [], []
+        for name, weight, timeout, future in zip(names, weights, timeouts, futures):
+            # Each retriever has its own deadline (all of them started at the same time)
+            wait([future], timeout=max(start + timeout - time.time(), 0))
+            if not future.done():
+                future.cancel()
+                self._record(name, time.time() - start, "timeout")
+                print(f"Retrieval: {name} did not answer within {timeout}s, ignored")
+                continue
+            try:
+                documents, seconds = future.result()
+            except Exception as e:
+                self._record(name, time.time() - start, "error")
+                print(f"Retrieval: {name} failed, ignored: {e}")
+                continue
+            self._record(name, seconds, "ok")
+            rankings.append(documents)
+            ranking_weights.append(weight)
+
+        return reciprocal_rank_fusion(rankings, ranking_weights)
+
+    def _record(self, name: str, seconds: float, status: str) -> None:
+        with self._lock:
+            leg = self._stats.setdefault(name, {"calls": 0, "timeouts": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0, "last_seconds": 0.0})
+            leg["calls"] += 1
+            leg["timeouts"] += status == "timeout"
+            leg["errors"] += status == "error"
+            leg["total_seconds"] += seconds
+            leg["max_seconds"] = max(leg["max_seconds"], seconds)
+            leg["last_seconds"] = seconds
+
+    def stats(self) -> dict:
+        """
+        Timings of each retriever (leg) since the creation of this object
+        """
+
+        with self._lock:
+            return {
+                name: {
+                    "calls": leg["calls"],
+                    "timeouts": leg["timeouts"],
+                    "errors": leg["errors"],
+                    "mean_seconds": round(leg["total_seconds"] / leg["calls"], 3),
+                    "max_seconds": round(leg["max_seconds"], 3),
+                    "last_seconds": round(leg["last_seconds"], 3),
+                }
+                for name, leg in self._stats.items()
+            }
+
+
+def query_variants(variants: dict) -> list:
+    """
+    List of the queries to retrieve: the standalone question and its translations, without empty or duplicate queries
+    """
+
+    queries = [query.strip() for query in variants.values() if query]
+    return list(dict.fromkeys(query for query in queries if query))
+
+
+def parse_query_variants(text: str, question: str) -> dict:
+    """
+    Parse the JSON object written by the model ({"standalone_question": ..., "French": ..., ...}, the standalone
+    question is optional). Returns {"standalone_question", "queries"}. If the output is not a JSON object, it is
+    taken as the standalone question (no translations).
+    """
+
+    match = re.search(r"\{.*\}", text, re.DOTALL)  # The JSON object can be in a code block
+    try:
+        variants = json.loads(match.group(0)) if match else None
+    except ValueError:
+        variants = None
+    if not isinstance(variants, dict):
+        standalone_question = text.strip() or question
+        return {"standalone_question": standalone_question, "queries": [standalone_question]}
+
+    variants = {key: value for key, value in variants.items() if isinstance(value, str)}
+    standalone_question = (variants.pop("standalone_question", "") or question).strip()
+
+    return {"standalone_question": standalone_question, "queries": query_variants({"standalone_question": standalone_question, **variants})}
+
+
+def multi_query_retrieve(retriever, queries: list, max_results: int = RETRIEVAL_MAX_RESULTS) -> list:
+    """
+    Retrieve the documents of each query concurrently (batch runs the queries on a pool of threads),
+    and fuse the results with RRF
+    """
+
+    if not queries:
+        return []
+
+    rankings = retriever.batch(queries, config={"max_concurrency": len(queries)})
+
+    return reciprocal_rank_fusion(rankings)[:max_results]
+
+
+def maximal_marginal_relevance(query_vector, vectors, k: int, lambda_mult: float = MMR_LAMBDA) -> list:
+    """
+    Select k rows of vectors with the MMR: at each step, the row maximizing
+    lambda_mult * similarity to the query - (1 - lambda_mult) * max similarity to the rows already selected.
+    All the similarities are computed at once (one matrix product). Returns the selected rows, in order.
+    """
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if not len(vectors):
+        return []
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_vector, dtype=np.float32)
+    query = query / (np.linalg.norm(query) or 1.0)
+
+    relevance = vectors @ query
+    similarity = vectors @ vectors.T
+
+    selected = [int(np.argmax(relevance))]
+    max_similarity = similarity[selected[0]].copy()  # Max similarity of each row to the selected rows
+    while len(selected) < min(k, len(vectors)):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        max_similarity = np.maximum(max_similarity, similarity[best])
+
+    return selected
+
+
+def diversify(documents: list, query_vector, document_vectors, k: int = RETRIEVAL_MAX_RESULTS, lambda_mult: float = MMR_LAMBDA) -> list:
+    """
+    Keep k of the documents with the MMR, with the vectors of the documents stored in the vector DB
+    (document_vectors(ids) returns a dictionary ID -> vector). A document without vector is kept after the others.
+    """
+
+    if len(documents) <= k:
+        return documents
+
+    vectors_by_id = document_vectors([document.id for document in documents if document.id])
+    with_vector = [document for document in documents if document.id in vectors_by_id]
+    without_vector = [document for document in documents if document.id not in vectors_by_id]
+
+    selected = maximal_marginal_relevance(query_vector, [vectors_by_id[document.id] for document in with_vector], k, lambda_mult)
+
+    return ([with_vector[row] for row in selected] + without_vector)[:k]
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+# Ragai - (c) Eric Dodémont, 2024.
+
+"""
+Streaming output: the chunks of the streamed answer are buffered and rendered in the Streamlit container on a
+time/size cadence (not once per chunk: each rendering sends the whole answer again). The answer is built with
+a list of chunks joined when rendered. The time to first token and the total stream time are recorded.
+"""
+
+import time
+
+from modules.tracing import record_span
+from config.config import *
+
+
+class StreamingRenderer:
+    """
+    Render a streamed answer in a container (e.g. st.empty()). The first chunk is rendered at once, the next
+    ones at most every flush_seconds, or as soon as flush_max_characters characters are waiting.
+    """
+
+    def __init__(self, container, flush_seconds: float = STREAM_FLUSH_SECONDS, flush_max_characters: int = STREAM_FLUSH_MAX_CHARACTERS):
+        self.container = container
+        self.flush_seconds = flush_seconds
+        self.flush_max_characters = flush_max_characters
+        self.chunks = []  # Whole answer
+        self.rendered = 0  # Number of chunks already rendered
+        self.waiting_characters = 0
+        self.start = time.time()
+        self.first_token = None
+        self.flushed_at = 0.0
+        self.flushes = 0
+
+    def write(self, chunk: str) -> None:
+        if not chunk:
+            return
+        now = time.time()
+        if self.first_token is None:
+            self.first_token = now
+            record_span("stream.ttft", now - self.start, start=self.start)
+        self.chunks.append(chunk)
+        self.waiting_characters += len(chunk)
+        if self.rendered == 0 or now - self.flushed_at >= self.flush_seconds or self.waiting_characters >= self.flush_max_characters:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.rendered == len(self.chunks):
+            return
+        self.container.write(self.answer)
+        self.rendered = len(self.chunks)
+        self.waiting_characters = 0
+        self.flushed_at = time.time()
+        self.flushes += 1
+
+    @property
+    def answer(self) -> str:
+        return "".join(self.chunks)
+
+    def close(self) -> str:
+        """
+        Render the last chunks and record the stream time. Returns the answer.
+        """
+
+        self.flush()
+        seconds = time.time() - self.start
+        ttft = self.first_token - self.start if self.first_token is not None else None
+        record_span("stream.total", seconds, start=self.start, chunks=len(self.chunks), flushes=self.flushes)
+        print(f"Stream: {len(self.chunks)} chunks, {self.flushes} renderings, time to first token: {ttft if ttft is None else round(ttft, 2)}s, total: {seconds:.2f}s")
+
+        return self.answer
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+# Ragai - (c) Eric Dodémont, 2024.
+
+"""
+Per-stage latency tracing. A trace is one request (a question, a scraping or an ingestion job); a span is one
+stage of the request (contextualize, embed the query, BM25, Chroma query, generation, etc.) with its duration
+and attributes (e.g. tokens, tokens per second). The current trace is in a context variable, so the stages
+running in other threads (copied context) are recorded in the same trace.
+The finished traces are exported in a JSONL file and in a Prometheus text file, and kept in memory for the
+latency dashboard of the admin page (p50/p95/p99 per stage).
+"""
+
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+from langchain_core.runnables import RunnableLambda
+
+from config.config import *
+
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Span:
+    """
+    One stage of a request: name, start (relative to the start of the trace), duration, attributes
+    """
+
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = None
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def to_dict(self, trace_start: float) -> dict:
+        return {"name": self.name, "start": round(self.start - trace_start, 4), "seconds": round(self.duration or 0.0, 4), **self.attributes}
+
+
+class Trace:
+    """
+    One request (question, scraping or ingestion job) and its spans
+    """
+
+    def __init__(self, name: str, attributes: dict):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = None
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add_span(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = [span.to_dict(self.start) for span in self.spans]
+        return {
+            "trace_id": self.id,
+            "name": self.name,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start)),
+            "seconds": round(self.duration or 0.0, 4),
+            **self.attributes,
+            "spans": spans,
+        }
+
+
+class TraceStore:
+    """
+    Recent traces and durations of each stage (in memory, bounded), and the exporters (JSONL, Prometheus text)
+    """
+
+    def __init__(self, max_samples: int = TRACING_MAX_SAMPLES, jsonl_path: str = TRACING_JSONL_PATH, prometheus_path: str = TRACING_PROMETHEUS_PATH, jsonl_max_size_mb: float = TRACING_JSONL_MAX_SIZE_MB, jsonl_backups: int = TRACING_JSONL_BACKUPS):
+        self.max_samples = max_samples
+        self.jsonl_path = jsonl_path
+        self.jsonl_max_size = int(jsonl_max_size_mb * 1024 * 1024)  # In bytes
+        self.jsonl_backups = jsonl_backups
+        self.prometheus_path = prometheus_path
+        self.traces = deque(maxlen=100)  # Last traces (for the dashboard)
+        self.durations = {}  # Stage -> last durations (seconds)
+        self.counts = {}  # Stage -> number of spans since the start of the app
+        self.sums = {}  # Stage -> total seconds since the start of the app
+        self.tokens = {}  # Stage -> total tokens since the start of the app
+        self.tokens_per_second = {}  # Stage -> last tokens per second
+        self._lock = threading.Lock()
+
+    def record_stage(self, stage: str, seconds: float, attributes: dict) -> None:
+        with self._lock:
+            self.durations.setdefault(stage, deque(maxlen=self.max_samples)).append(seconds)
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+            self.sums[stage] = self.sums.get(stage, 0.0) + seconds
+            if "tokens" in attributes:
+                self.tokens[stage] = self.tokens.get(stage, 0) + attributes["tokens"]
+            if "tokens_per_second" in attributes:
+                self.tokens_per_second.setdefault(stage, deque(maxlen=self.max_samples)).append(attributes["tokens_per_second"])
+
+    def record_trace(self, trace: Trace) -> None:
+        self.record_stage(trace.name, trace.duration, trace.attributes)
+        record = trace.to_dict()
+        with self._lock:
+            self.traces.append(record)
+            try:
+                os.makedirs(os.path.dirname(self.jsonl_path) or ".", exist_ok=True)
+                self._rotate()
+                with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+            except OSError as e:
+                print(f"Tracing: cannot write {self.jsonl_path}: {e}")
+        self.export_prometheus()
+
+    def _rotate(self) -> None:
+        """
+        Rotate the JSONL file above jsonl_max_size: traces.jsonl -> traces.jsonl.1 -> ... -> traces.jsonl.{backups}
+        (the oldest one is deleted). Lock held by the caller.
+        """
+
+        try:
+            if os.path.getsize(self.jsonl_path) < self.jsonl_max_size:
+                return
+        except FileNotFoundError:
+            return
+
+        for number in range(self.jsonl_backups - 1, 0, -1):
+            if os.path.exists(f"{self.jsonl_path}.{number}"):
+                os.replace(f"{self.jsonl_path}.{number}", f"{self.jsonl_path}.{number + 1}")
+        if self.jsonl_backups > 0:
+            os.replace(self.jsonl_path, f"{self.jsonl_path}.1")
+        else:
+            os.remove(self.jsonl_path)
+
+    def recent_traces(self) -> list:
+        """
+        Last traces, the most recent first
+        """
+
+        with self._lock:
+            return list(reversed(self.traces))
+
+    def summary(self) -> list:
+        """
+        Latency of each stage: count, p50, p95, p99, mean (milliseconds), and tokens
+        """
+
+        with self._lock:
+            stages = {stage: np.array(durations) for stage, durations in self.durations.items()}
+            counts = dict(self.counts)
+            tokens = dict(self.tokens)
+            tokens_per_second = {stage: np.array(values) for stage, values in self.tokens_per_second.items()}
+
+        rows = []
+        for stage, durations in sorted(stages.items()):
+            p50, p95, p99 = np.percentile(durations, [50, 95, 99]) * 1000
+            row = {
+                "stage": stage,
+                "count": counts[stage],
+                "p50_ms": round(float(p50), 1),
+                "p95_ms": round(float(p95), 1),
+                "p99_ms": round(float(p99), 1),
+                "mean_ms": round(float(durations.mean()) * 1000, 1),
+            }
+            if stage in tokens:
+                row["tokens"] = tokens[stage]
+            if stage in tokens_per_second:
+                row["tokens_per_second_p50"] = round(float(np.percentile(tokens_per_second[stage], 50)), 1)
+            rows.append(row)
+
+        return rows
+
+    def prometheus_text(self) -> str:
+        """
+        Metrics in the Prometheus text format (summaries of the durations per stage, and tokens)
+        """
+
+        lines = [
+            "# HELP ragai_stage_duration_seconds Duration of each stage of the requests",
+            "# TYPE ragai_stage_duration_seconds summary",
+        ]
+        with self._lock:
+            stages = {stage: np.array(durations) for stage, durations in self.durations.items()}
+            counts = dict(self.counts)
+            sums = dict(self.sums)
+            tokens = dict(self.tokens)
+        for stage, durations in sorted(stages.items()):
+            for quantile in (0.5, 0.95, 0.99):
+                lines.append(f'ragai_stage_duration_seconds{{stage="{stage}",quantile="{quantile}"}} {np.percentile(durations, quantile * 100):.6f}')
+            lines.append(f'ragai_stage_duration_seconds_sum{{stage="{stage}"}} {sums[stage]:.6f}')
+            lines.append(f'ragai_stage_duration_seconds_count{{stage="{stage}"}} {counts[stage]}')
+        lines += [
+            "# HELP ragai_stage_tokens_total Tokens processed by each stage",
+            "# TYPE ragai_stage_tokens_total counter",
+        ]
+        for stage, total in sorted(tokens.items()):
+            lines.append(f'ragai_stage_tokens_total{{stage="{stage}"}} {total}')
+
+        return "\n".join(lines) + "\n"
+
+    def export_prometheus(self) -> None:
+        """
+        Write the metrics in a file (for the textfile collector of the node exporter), atomically
+        """
+
+        try:
+            os.makedirs(os.path.dirname(self.prometheus_path) or ".", exist_ok=True)
+            tmp_path = f"{self.prometheus_path}.tmp{os.getpid()}"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(self.prometheus_text())
+            os.replace(tmp_path, self.prometheus_path)
+        except OSError as e:
+            print(f"Tracing: cannot write {self.prometheus_path}: {e}")
+
+    def clear(self) -> None:
+        with self._lock:
+            self.traces.clear()
+            self.durations.clear()
+            self.counts.clear()
+            self.sums.clear()
+            self.tokens.clear()
+            self.tokens_per_second.clear()
+
+
+trace_store = TraceStore()  # Shared by all the chat sessions and the admin page
+
+
+@contextmanager
+def start_trace(name: str, **attributes):
+    """
+    Trace a request (all the spans opened inside are recorded in it)
+    """
+
+    if not TRACING:
+        yield None
+        return
+
+    trace = Trace(name, attributes)
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        trace.duration = time.time() - trace.start
+        try:
+            current_trace.reset(token)
+        except ValueError:
+            pass  # Generator (streamed answer) closed from another context
+        trace_store.record_trace(trace)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Trace a stage of the current request. Attributes can be added with span.set(...) (e.g. tokens: the
+    tokens per second are then computed). Without current trace, only the duration of the stage is recorded.
+    """
+
+    if not TRACING:
+        yield Span(name, attributes)
+        return
+
+    current = Span(name, attributes)
+    try:
+        yield current
+    finally:
+        current.duration = time.time() - current.start
+        if "tokens" in current.attributes and current.duration > 0 and "tokens_per_second" not in current.attributes:
+            current.attributes["tokens_per_second"] = round(current.attributes["tokens"] / current.duration, 1)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add_span(current)
+        trace_store.record_stage(name, current.duration, current.attributes)
+
+
+def record_span(name: str, seconds: float, start: float = None, **attributes) -> None:
+    """
+    Record a stage measured elsewhere (e.g. time to first token). start: time.time() at the start of the stage
+    (default: the stage has just ended).
+    """
+
+    if not TRACING:
+        return
+
+    current = Span(name, attributes)
+    current.start = start if start is not None else current.start - seconds
+    current.duration = seconds
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_span(current)
+    trace_store.record_stage(name, seconds, attributes)
+
+
+def traced_runnable(name: str, runnable):
+    """
+    Wrap a Langchain runnable in a span
+    """
+
+    def invoke(inputs, config):
+        with span(name):
+            return runnable.invoke(inputs, config)
+
+    return RunnableLambda(invoke, name=name)
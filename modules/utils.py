@@ -13,58 +13,193 @@ sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
 
 import streamlit as st
 import shutil
-from langchain_community.document_loaders import JSONLoader, PyPDFLoader
-from langchain_openai import OpenAIEmbeddings
-from langchain_chroma import Chroma
-import chromadb
-from chromadb.config import Settings
-import os
+import hashlib
+import json
+import itertools
+from langchain_core.documents import Document
 
+from modules.bm25_index import delete_bm25_index, read_bm25_index_for_update, save_updated_bm25_index
+from modules.document_loaders import iter_json_documents, iter_pdf_documents
+from modules.embedding_cache import get_embedding_model
+from modules.ingestion import embed_and_write
+from modules.chroma_utils import bump_collection_version, get_vector_db, iter_collection
+from modules.tracing import span
 from config.config import *
 
 
-def load_files_and_embed(json_file_paths: list, pdf_file_paths: list, embed: bool) -> None:
+def get_document_id(document: Document, chunk_number: int = 0) -> str:
     """
-    Loads and chunks files into a list of documents then embed
+    Stable ID of a document, derived from the URL of the web page (JSON item), or from the path, the page
+    number and the chunk number in the page (PDF page). The same page always gets the same ID.
     """
 
+    if "page" in document.metadata:  # PDF page
+        key = f"pdf:{document.metadata['source']}:{document.metadata['page']}:{chunk_number}"
+    else:  # Web page (JSON item)
+        try:
+            key = f"url:{json.loads(document.page_content)['url']}"
+        except Exception:
+            key = f"json:{document.metadata.get('source')}:{document.metadata.get('seq_num')}"
+
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def get_content_hash(document: Document) -> str:
+    """
+    Hash of the content of a document, to detect the documents changed since they were embedded
+    """
+
+    return hashlib.sha256(document.page_content.encode("utf-8")).hexdigest()
+
+
+def with_ids_and_hashes(documents, seen_ids: set):
+    """
+    Give a stable ID and a content hash (in the metadata) to each document. If several documents get the
+    same ID (same web page in several JSON files), only the first one is kept.
+    Yields (document, ID) pairs. The IDs are added to seen_ids.
+    """
+
+    chunk_numbers = {}  # Page -> number of chunks already seen in this page of the current PDF file
+    current_source = None
+    for document in documents:
+        chunk_number = 0
+        if "page" in document.metadata:
+            if document.metadata["source"] != current_source:
+                chunk_numbers = {}  # New PDF file: forget the pages of the previous one
+                current_source = document.metadata["source"]
+            chunk_number = chunk_numbers.get(document.metadata["page"], 0)
+            chunk_numbers[document.metadata["page"]] = chunk_number + 1
+        doc_id = get_document_id(document, chunk_number)
+        if doc_id in seen_ids:
+            continue
+        seen_ids.add(doc_id)
+        document.metadata["content_hash"] = get_content_hash(document)
+        yield document, doc_id
+
+
+def count_documents(documents, counts: dict, key: str):
+    """
+    Count the documents (in counts[key]) while they are streamed
+    """
+
+    for document in documents:
+        counts[key] += 1
+        yield document
+
+
+def write_documents(vector_db, documents, sync: bool) -> None:
+    """
+    Write (upsert) the documents (from a generator) in the collection, with their stable IDs, batch by batch.
+    Sync mode: only the new or changed documents are written, and the documents which are not
+    in the files anymore are deleted from the collection.
+    """
+
+    # IDs and content hashes of the documents in the collection (no document text, no vector)
+    existing_hashes = {}
+    if sync:
+        with span("ingestion.read_hashes") as current:
+            for page in iter_collection(vector_db, include=("metadatas",)):
+                for doc_id, metadata in zip(page["ids"], page["metadatas"]):
+                    existing_hashes[doc_id] = (metadata or {}).get("content_hash")
+            current.set(documents=len(existing_hashes))
+
+    # The BM25 index is updated batch by batch, with the written documents
+    with span("ingestion.bm25_read"):
+        bm25_index = read_bm25_index_for_update(vector_db)
+
+    seen_ids = set()
+    nbr_unchanged = [0]
+
+    def documents_to_write():
+        for document, doc_id in with_ids_and_hashes(documents, seen_ids):
+            if sync and existing_hashes.get(doc_id) == document.metadata["content_hash"]:
+                nbr_unchanged[0] += 1
+                continue
+            yield document, doc_id
+
+    nbr_written = [0]
+
+    def index_batch(batch_documents, batch_ids):
+        nbr_written[0] += len(batch_ids)
+        if bm25_index is not None:
+            bm25_index.add(batch_ids, [document.page_content for document in batch_documents])
+
+    progress_text = st.empty()
+
+    def show_progress(nbr_written, elapsed):
+        progress_text.write(f"Written in DB: {nbr_written} pages ({nbr_written / max(elapsed, 1e-6):.1f} pages/s)")
+
+    removed_ids = []
+    completed = False
     try:
+        with span("ingestion.embed_and_write") as current:
+            stats = embed_and_write(vector_db, documents_to_write(), progress_callback=show_progress, written_callback=index_batch)  # Upsert
+            current.set(documents=stats["documents"], batches=stats["batches"], retries=stats["retries"])
+        st.write(f"Embedding: {stats['documents']} pages in {stats['seconds']}s ({stats['documents_per_second']} pages/s), {stats['batches']} requests, {stats['retries']} retries after rate limiting")
 
-        embedding_model = OpenAIEmbeddings(model=EMBEDDING_MODEL)
-
-        nbr_files = len(json_file_paths)
-        st.write(f"Number of JSON files: {nbr_files}")
-        documents = []
-        for json_file_path in json_file_paths:
-            loader = JSONLoader(file_path=json_file_path, jq_schema=".[]", text_content=False)
-            docs = loader.load()   # 1 JSON item per chunk
-            print(f"JSON file: {json_file_path}, Number of web pages: {len(docs)}")
-            documents = documents + docs
-        st.write(f"Number of web pages: {len(documents)}")
-        if embed:
-            st.write('Create DB client...')
-            #chroma_client = chromadb.HttpClient(host=CHROMA_SERVER_HOST, port=CHROMA_SERVER_PORT)
-            chroma_server_password = os.getenv("CHROMA_SERVER_AUTHN_CREDENTIALS", "YYYY")
-            chroma_client = chromadb.HttpClient(host=CHROMA_SERVER_HOST, port=CHROMA_SERVER_PORT, settings=Settings(chroma_client_auth_provider="chromadb.auth.token_authn.TokenAuthClientProvider", chroma_client_auth_credentials=chroma_server_password))
-            st.write('Write web pages in DB...')
-            Chroma.from_documents(documents, embedding=embedding_model, collection_name=CHROMA_COLLECTION_NAME, client=chroma_client)
-            st.write('Write in DB: done')
+        removed_ids = [doc_id for doc_id in existing_hashes if doc_id not in seen_ids]
+        if removed_ids:
+            with span("ingestion.delete", documents=len(removed_ids)):
+                for i in range(0, len(removed_ids), CHROMA_WRITE_BATCH_SIZE):
+                    vector_db.delete(ids=removed_ids[i:i + CHROMA_WRITE_BATCH_SIZE])
+        if sync:
+            st.write(f"Sync: {stats['documents']} new or changed pages, {nbr_unchanged[0]} unchanged pages, {len(removed_ids)} removed pages")
+        completed = True
+
+    finally:
+        # Also after a failure: the batches already written must get a new version, else the BM25 index,
+        # the answer cache and the local vector index would still consider the old version as current
+        if nbr_written[0] or removed_ids:
+            new_version = bump_collection_version(vector_db)
+            if completed:
+                with span("ingestion.bm25_save"):
+                    if bm25_index is not None:
+                        bm25_index.remove(removed_ids)
+                    save_updated_bm25_index(vector_db, bm25_index, new_version)
+                st.write('Update of the BM25 index: done')
+            else:
+                delete_bm25_index()  # Partial write: rebuilt from the collection when loaded
+                print(f"Partial write in the collection: {nbr_written[0]} pages written (collection version: {new_version}), BM25 index deleted")
+
+
+def load_files_and_embed(json_file_paths: list, pdf_file_paths: list, embed: bool, sync: bool = False) -> None:
+    """
+    Loads and chunks files into a stream of documents then embed (batch by batch: the whole corpus is
+    never in memory, and the first batches are written while the next files are read).
+    Sync mode: only embed the new or changed documents, and delete the removed ones.
+    """
+
+    try:
+
+        embedding_model = get_embedding_model()  # With the persistent cache: the unchanged pages are not embedded again
+
+        st.write(f"Number of JSON files: {len(json_file_paths)}")
+        st.write(f"Number of PDF files: {len(pdf_file_paths)}")
+
+        counts = {"web": 0, "pdf": 0}
+        pdf_stats = {}  # Pages parsed by each worker process
+        documents = itertools.chain(
+            count_documents(iter_json_documents(json_file_paths), counts, "web"),  # 1 JSON item per chunk
+            count_documents(iter_pdf_documents(pdf_file_paths, pdf_stats), counts, "pdf"),  # 1 pdf page per chunk
+        )
 
-        nbr_files = len(pdf_file_paths)
-        st.write(f"Number of PDF files: {nbr_files}")
-        documents2 = []
-        if pdf_file_paths:  # if equals to "", then skip
-            for pdf_file_path in pdf_file_paths:
-                loader = PyPDFLoader(pdf_file_path)
-                pages = loader.load_and_split()  # 1 pdf page per chunk
-                print(f"PDF file: {pdf_file_path}, Number of PDF pages: {len(pages)}")
-                documents2 = documents2 + pages
-        st.write(f"Number of PDF pages: {len(documents2)}")
-        st.write(f"Number of web and pdf pages: {len(documents) + len(documents2)}")
         if embed:
-            st.write('Write pdf pages in DB...')
-            Chroma.from_documents(documents2, embedding=embedding_model, collection_name=CHROMA_COLLECTION_NAME, client=chroma_client)
+            st.write('Get DB client...')
+            vector_db = get_vector_db(embedding_model)
+            st.write('Write web and pdf pages in DB...')
+            write_documents(vector_db, documents, sync)
             st.write('Write in DB: done')
+            stats = embedding_model.stats()
+            st.write(f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses (pages embedded)")
+        else:
+            for document in documents:
+                pass
+
+        st.write(f"Number of web pages: {counts['web']}")
+        st.write(f"Number of PDF pages: {counts['pdf']}")
+        st.write(f"Number of web and pdf pages: {counts['web'] + counts['pdf']}")
+        for pid, worker_stats in pdf_stats.items():
+            st.write(f"PDF parsing worker {pid}: {worker_stats['pages']} pages in {worker_stats['seconds']:.1f}s ({worker_stats['pages'] / max(worker_stats['seconds'], 1e-6):.1f} pages/s)")
 
     except Exception as e:
         st.write("Error: The Chroma vector DB is not available locally. Is it running on a remote server?")
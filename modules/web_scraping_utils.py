@@ -6,43 +6,62 @@
 Functions to scrape the text and the metadata of web pages
 """
 
-import requests, bs4
+import contextvars
+import json
+import os
+import time
 from bs4 import BeautifulSoup
-from langchain_community.document_loaders import WebBaseLoader
 from typing import Any
 import streamlit as st
-import requests, json
-from bs4 import BeautifulSoup
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
+from modules.http_cache import http_get
+from modules.tracing import span
 from config.config import *
 
 
-def scrape_web_page(url: str, filter: str) -> dict[str, Any]:
+# Faster HTML parser if available
+try:
+    import lxml
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+# Max number of concurrent requests per host
+host_semaphores = {}
+host_semaphores_lock = threading.Lock()
+
+
+def get_host_semaphore(url: str) -> threading.Semaphore:
     """
-    Name: swp
-    Scrape the text and the metadata of a web page
-    Input: url of the page, css class to filter
-    Output: dictionary with: url: url, metadata: metadata, text: text
+    Return the semaphore limiting the number of concurrent requests to the host of the URL
     """
 
-    # Get the page content
-    loader = WebBaseLoader(
-        web_paths=(url,),
-        bs_kwargs=dict(
-            parse_only=bs4.SoupStrainer(
-                class_=(filter)
-            )
-        ),
-    )
-    text = loader.load()
-    # Covert Document type into string type
-    text = text[0].page_content
-
-    # Get the metadata (open graph from Facebook, og:xxx)
-    # Get the HTML code
-    response = requests.get(url)
-    # Transform the HTML code from a Response object type into a BeautifulSoup object type to be scraped by Beautiful Soup
-    soup = BeautifulSoup(response.text, "html.parser")
+    host = urlparse(url).netloc
+    with host_semaphores_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = threading.Semaphore(SCRAPING_MAX_CONCURRENCY_PER_HOST)
+        return host_semaphores[host]
+
+
+def parse_web_page(html: bytes, filter: str) -> tuple:
+    """
+    Parse the HTML code of a web page once, and extract both the text filtered by the css class(es)
+    and the metadata (open graph from Facebook, og:xxx)
+    Input: HTML code, css class (or tuple of css classes) to filter
+    Output: text, metadata
+    """
+
+    soup = BeautifulSoup(html, HTML_PARSER)
+
+    # Get the text of the elements with the css class(es), like the SoupStrainer(class_=filter) of the
+    # WebBaseLoader: the text of the nested elements with the same class is taken only once
+    elements = soup.find_all(class_=filter)
+    matched = set(map(id, elements))
+    text = "".join(element.get_text() for element in elements if not any(id(parent) in matched for parent in element.parents))
+
     # Get the metadata fields
     metadata = {}
     # Find all the meta tags in the HTML
@@ -55,6 +74,24 @@ def scrape_web_page(url: str, filter: str) -> dict[str, Any]:
         if property and content:
             metadata[property] = content
 
+    return text, metadata
+
+
+def scrape_web_page(url: str, filter: str) -> dict[str, Any]:
+    """
+    Name: swp
+    Scrape the text and the metadata of a web page (one HTTP request and one HTML parsing per page)
+    Input: url of the page, css class to filter
+    Output: dictionary with: url: url, metadata: metadata, text: text
+    """
+
+    # Get the HTML code (through the HTTP cache)
+    with span("scraping.fetch"):
+        response = http_get(url)
+    # The bytes are given to Beautiful Soup, which detects the encoding
+    with span("scraping.parse"):
+        text, metadata = parse_web_page(response.content, filter)
+
     # Build JSON string with: url: url, metadata: metadata, text: summary text
     # Create a dictionary
     page = {
@@ -66,6 +103,133 @@ def scrape_web_page(url: str, filter: str) -> dict[str, Any]:
     return page  # Dictionary
 
 
+def scrape_web_pages(urls: list, filter: str):
+    """
+    Scrape concurrently a list of web pages (at most SCRAPING_MAX_CONCURRENCY_PER_HOST requests at once per host).
+    Yields the pages (see scrape_web_page) in the same order as the URLs.
+    """
+
+    def scrape(url):
+        with get_host_semaphore(url):
+            return scrape_web_page(url, filter)
+
+    with ThreadPoolExecutor(max_workers=SCRAPING_MAX_WORKERS) as executor:
+        # Copied context: the spans of the workers are recorded in the trace of the scraping job
+        futures = [executor.submit(contextvars.copy_context().run, scrape, url) for url in urls]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()  # The consumer stopped early: do not scrape the next pages
+
+
+def fetch_subcategories(category: str) -> list:
+    """
+    For Wikimedia Commons: Return the names of the direct subcategories of a category
+    """
+
+    url = f"{COMMONS_URL}/wiki/Category:{category.replace(' ', '_')}"
+    for attempt in range(SCRAPING_MAX_RETRIES + 1):
+        with get_host_semaphore(url), span("scraping.category_page", attempt=attempt):
+            response = http_get(url, revalidate=True)  # Listing page: subcategories can be added
+        if response.status_code == 200:
+            break
+        # An error page (e.g. 429 Too Many Requests) must not be parsed as a category without subcategories
+        if attempt == SCRAPING_MAX_RETRIES or (response.status_code != 429 and response.status_code < 500):
+            raise RuntimeError(f"Cannot fetch {url}: HTTP status {response.status_code}")
+        delay = SCRAPING_BACKOFF_SECONDS * 2 ** attempt
+        print(f"Scraping: HTTP status {response.status_code} for {url}, retry in {delay}s")
+        time.sleep(delay)
+    soup = BeautifulSoup(response.content, HTML_PARSER)
+
+    subcategories = []
+    subcat_div = soup.find('div', {'id': 'mw-subcategories'})
+    if subcat_div:
+        for link in subcat_div.find_all('a'):
+            if 'Category:' in link.get('title', ''):
+                subcategories.append(link.get('title').replace('Category:', ''))
+
+    return subcategories
+
+
+def load_categories_memo() -> dict:
+    """
+    Subcategories of the categories already walked (category -> {"subcategories": [...], "fetched_at": time})
+    """
+
+    try:
+        with open(COMMONS_CATEGORIES_MEMO_PATH, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_categories_memo(memo: dict) -> None:
+    os.makedirs(os.path.dirname(COMMONS_CATEGORIES_MEMO_PATH) or ".", exist_ok=True)
+    tmp_path = f"{COMMONS_CATEGORIES_MEMO_PATH}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(memo, f)
+    os.replace(tmp_path, COMMONS_CATEGORIES_MEMO_PATH)
+
+
+def get_subcategories(category: str, max_depth: int = 9) -> tuple:
+    """
+    For Wikimedia Commons: Walk the tree (graph) of the subcategories of a category, breadth-first, up to
+    max_depth levels (the category itself is level 1). Each category is visited once, even if the graph has
+    cycles or several paths to the same category. The categories of a level are fetched concurrently, and the
+    subcategories of each category are memoized on the local filesystem for the next runs. A category which
+    cannot be fetched is not memoized (its subcategories are missing from this run only, see stats["errors"]).
+    Returns the flat list of the unique categories (the category first), and statistics.
+    """
+
+    memo = load_categories_memo()
+    now = time.time()
+    stats = {"categories": 0, "fetched": 0, "memoized": 0, "duplicates_skipped": 0, "errors": 0}
+
+    category = category.replace("_", " ").strip()
+    categories = [category]
+    visited = {category}
+    level = [category]
+    depth = 1
+    while level and depth < max_depth:  # The subcategories of the last level are not needed
+        # Fetch the categories of the level which are not memoized (or too old), concurrently
+        to_fetch = [c for c in level if c not in memo or now - memo[c]["fetched_at"] > COMMONS_CATEGORIES_MEMO_TTL_SECONDS]
+        failed = set()
+        with ThreadPoolExecutor(max_workers=SCRAPING_MAX_WORKERS) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, fetch_subcategories, c) for c in to_fetch]  # Spans in the trace of the job
+            for c, future in zip(to_fetch, futures):
+                try:
+                    memo[c] = {"subcategories": future.result(), "fetched_at": now}
+                except Exception as e:
+                    failed.add(c)
+                    print(f"Error: Cannot get the subcategories of {c}: {e}")
+        stats["fetched"] += len(to_fetch)
+        stats["memoized"] += len(level) - len(to_fetch)
+        stats["errors"] += len(failed)
+
+        # Next level: the subcategories not visited yet (in a deterministic order)
+        next_level = []
+        for c in level:
+            if c not in memo:
+                continue  # Failed (and never fetched before): no subcategories in this run
+            for subcategory in memo[c]["subcategories"]:
+                if subcategory in visited:
+                    stats["duplicates_skipped"] += 1
+                    continue
+                visited.add(subcategory)
+                categories.append(subcategory)
+                next_level.append(subcategory)
+        level = next_level
+        depth += 1
+
+    save_categories_memo(memo)
+    stats["categories"] = len(categories)
+    stats["fetches_saved"] = stats["memoized"] + stats["duplicates_skipped"]
+
+    return categories, stats
+
+
 def scrape_commons_category(category: str) -> None:
     """
     For Wikimedia Commons: Scrape the URLs from a Category and save the results in a JSON file
@@ -84,8 +248,8 @@ def scrape_commons_category(category: str) -> None:
     href_old = ""
 
     # Step 1: Load the HTML content from a webpage
-    url = f"https://commons.wikimedia.org/wiki/Category:{category}"
-    response = requests.get(url)
+    url = f"{COMMONS_URL}/wiki/Category:{category}"
+    response = http_get(url, revalidate=True)  # Listing page: files can be added
     html_content = response.text
 
     # Step 2: Parse the HTML content
@@ -97,18 +261,20 @@ def scrape_commons_category(category: str) -> None:
         href = link.get('href')
         if href:
             if href.startswith("/wiki/File:") and href != href_old: # This test because all links are in double!
-                urls.append(f"https://commons.wikimedia.org{href}")
+                urls.append(f"{COMMONS_URL}{href}")
                 href_old = href
 
     number_of_pages = len(urls)
     st.write(f"Number of pages to scrape: {number_of_pages}")
 
+    urls = [url.replace("\ufeff", "") for url in urls]  # Remove BOM (Byte order mark at the start of a text stream)
+
+    # The pages are scraped concurrently, but the items are in the same order as the URLs
     i = 1
     items = []
-    for url in urls:
-        st.write(f"Scraping {i}/{number_of_pages}...")
-        url = url.replace("\ufeff", "")  # Remove BOM (Byte order mark at the start of a text stream)
-        item = scrape_web_page(url, (FILTER1, FILTER2))
+    progress = st.empty()
+    for item in scrape_web_pages(urls, (FILTER1, FILTER2)):
+        progress.write(f"Scraped {i}/{number_of_pages}...")
         print(item)
         items.append(item)
         i = i + 1
@@ -14,14 +14,19 @@ import subprocess
 import io
 import json
 import glob
-import requests
 from bs4 import BeautifulSoup
-import chromadb
-from chromadb.config import Settings
-from langchain_chroma import Chroma
 
-from modules.web_scraping_utils import scrape_commons_category, scrape_web_page_url
+from modules.web_scraping_utils import scrape_commons_category, scrape_web_page_url, get_subcategories
 from modules.utils import load_files_and_embed
+from modules.bm25_index import delete_bm25_index
+from modules.chroma_utils import count_collection, get_vector_db
+from modules.embedding_cache import get_embedding_model, query_embedding_cache
+from modules.local_vector_index import delete_old_local_vector_indexes
+from modules.http_cache import http_get, http_cache
+from modules.answer_cache import answer_cache
+from modules.context_packing import context_packing_stats
+from modules.assistant_backend import refresh_collection_version
+from modules.tracing import span, start_trace, trace_store
 from config.config import *
 
 
@@ -56,6 +61,15 @@ def clear_memory_and_cache():
     reset_conversation()
 
 
+def refresh_knowledge_base():
+    """
+    After a write in the collection: only the retrieval resources are built again (not the models)
+    """
+
+    refresh_collection_version()
+    reset_conversation()
+
+
 def restart_db():
     command = ['bash', './db.sh', 'restart']
     st.write("Wait 20 seconds...")
@@ -79,28 +93,8 @@ def zip_files(file_paths):
     return buffer
 
 
-def get_subcategories(category, depth=1, max_depth=9):
-    if depth > max_depth:
-        return []
-
-    url = f"https://commons.wikimedia.org/wiki/Category:{category}"
-    response = requests.get(url)
-    soup = BeautifulSoup(response.text, 'html.parser')
-
-    categories = [category]
-    subcat_div = soup.find('div', {'id': 'mw-subcategories'})
-    if subcat_div:
-        links = subcat_div.find_all('a')
-        for link in links:
-            if 'Category:' in link.get('title', ''):
-                subcat = link.get('title').replace('Category:', '')
-                categories.extend(get_subcategories(subcat, depth + 1, max_depth))
-
-    return categories
-
-
 def get_links(url):
-    response = requests.get(url)
+    response = http_get(url, revalidate=True)  # Listing page (e.g. search results): always revalidated
     soup = BeautifulSoup(response.text, 'html.parser')
     links = soup.find_all('a')
     notfiltered_links = [link.get('href') for link in links if link.get('href')]
@@ -145,7 +139,7 @@ if st.session_state.password_ok:
     # Side bar window: second page (Admin)  #
     # # # # # # # # # # # # # # # # # # # # #
     
-    options = ['Upload PDF Files', 'Delete all PDF Files', 'Upload JSON Files (Web Pages)', 'Restore: Upload JSON Files (Web Pages) in ZIP Format', 'Backup: Upload JSON Files (Web Pages) in ZIP Format', 'Backup: Download all JSON Files (Web Pages) in ZIP Format', 'Delete all JSON Files (Web Pages)', 'List all Web Pages URLs', 'List all URLs from Europeana search pages', 'Scrape Web Pages', 'Scrape Web Pages from Wikimedia Commons', 'Embed Pages in DB', 'Model and Temperature', 'Clear Memory and Streamlit Cache', 'Upload File (not in the knowledge base)']
+    options = ['Upload PDF Files', 'Delete all PDF Files', 'Upload JSON Files (Web Pages)', 'Restore: Upload JSON Files (Web Pages) in ZIP Format', 'Backup: Upload JSON Files (Web Pages) in ZIP Format', 'Backup: Download all JSON Files (Web Pages) in ZIP Format', 'Delete all JSON Files (Web Pages)', 'List all Web Pages URLs', 'List all URLs from Europeana search pages', 'Scrape Web Pages', 'Scrape Web Pages from Wikimedia Commons', 'Embed Pages in DB', 'Model and Temperature', 'Answer Cache', 'Latency Dashboard', 'Clear Memory and Streamlit Cache', 'Upload File (not in the knowledge base)']
     choice = st.sidebar.radio("Make your choice: ", options)
 
     if choice == "Scrape Web Pages":
@@ -161,10 +155,13 @@ if st.session_state.password_ok:
         if st.button("Start"):
             if urls_box:
                 urls = urls_box.splitlines()  # List of URLs
-            for url in urls:
-                if url and filter:
-                    scrape_web_page_url(url, filter)
-                    st.write(f"{url} web page scraped and saved in a JSON file!")
+            with start_trace("scraping", source="web pages"):
+                for url in urls:
+                    if url and filter:
+                        with span("scraping.web_page"):
+                            scrape_web_page_url(url, filter)
+                        st.write(f"{url} web page scraped and saved in a JSON file!")
+            st.write(f"HTTP cache: {http_cache.stats()}")
 
     elif choice == "Model and Temperature":
         st.caption("Change the model and the temperature for the present chat session.")
@@ -179,14 +176,23 @@ if st.session_state.password_ok:
         if st.button("Start"):
             if categories_box:
                 categories = categories_box.splitlines()  # List of categories
-            for category in categories:
-                if category:
-                    st.write('Getting the list of subcategories...')
-                    subcategories = get_subcategories(category)
-                    for subcategory in subcategories:
-                        st.write(f"Scraping the web pages... (Category: {subcategory})")
-                        scrape_commons_category(subcategory)
-                        st.write(f"Web pages scraped and saved in a JSON file!")
+            scraped = set()  # A subcategory can be in the tree of several categories
+            with start_trace("scraping", source="commons"):
+                for category in categories:
+                    if category:
+                        st.write('Getting the list of subcategories...')
+                        with span("scraping.subcategories", category=category):
+                            subcategories, stats = get_subcategories(category)
+                        st.write(f"Subcategories: {stats['categories']} unique categories, {stats['fetched']} pages fetched, {stats['fetches_saved']} fetches saved ({stats['memoized']} memoized, {stats['duplicates_skipped']} duplicates skipped), {stats['errors']} errors")
+                        for subcategory in subcategories:
+                            if subcategory in scraped:
+                                continue
+                            scraped.add(subcategory)
+                            st.write(f"Scraping the web pages... (Category: {subcategory})")
+                            with span("scraping.category", category=subcategory):
+                                scrape_commons_category(subcategory)
+                            st.write(f"Web pages scraped and saved in a JSON file!")
+            st.write(f"HTTP cache: {http_cache.stats()}")
 
     elif choice == "Upload File (not in the knowledge base)":
         st.caption("Upload a file in the 'files' directory.")
@@ -293,6 +299,30 @@ if st.session_state.password_ok:
             mime="application/zip"
         )
 
+    elif choice == "Answer Cache":
+        st.caption("Semantic cache of the answers: a question with the same meaning as a previous one (same model, temperature, and knowledge base) gets the cached answer. Only the first question of a conversation uses the cache; a question asked again in a conversation gets a new answer.")
+        st.write(answer_cache.stats())
+        st.write("Cache of the embeddings of the questions:")
+        st.write(query_embedding_cache.stats())
+        st.write("Context packing (tokens of the retrieved documents sent to the model):")
+        st.write(context_packing_stats.stats())
+        if st.button("Clear Answer Cache"):
+            answer_cache.clear()
+            st.write("Done!")
+
+    elif choice == "Latency Dashboard":
+        st.caption("Duration of each stage of the questions, scraping and ingestion jobs (since the start of the app, last durations only for the percentiles).")
+        st.dataframe(trace_store.summary(), use_container_width=True)
+        st.write("Last traces:")
+        for trace in trace_store.recent_traces():
+            with st.expander(f"{trace['timestamp']} - {trace['name']} - {trace['seconds']}s"):
+                st.json(trace)
+        st.write(f"Traces: {TRACING_JSONL_PATH}, metrics (Prometheus text format): {TRACING_PROMETHEUS_PATH}")
+        st.code(trace_store.prometheus_text(), language="text")
+        if st.button("Clear Latency Statistics"):
+            trace_store.clear()
+            st.write("Done!")
+
     elif choice == "Clear Memory and Streamlit Cache":
         st.caption("Clear the Langchain and Streamlit memory buffer and the Streamlit cache.")
         if st.button("Clear Memory and Streamlit Cache"):
@@ -342,6 +372,7 @@ if st.session_state.password_ok:
         # Load and index
 
         st.caption('Embed all the web and pdf pages (knowledge base) in the Chroma vector DB (knowledge base).')
+        st.caption('Sync: only embed the new or changed pages, and delete from the DB the pages which are not in the files anymore.')
 
         JSON_FILES_DIR = "./files/json_files/"
         PDF_FILES_DIR = "./files/pdf_files/"
@@ -361,19 +392,29 @@ if st.session_state.password_ok:
             pdf_paths.append(pdf_path)
 
         if st.button("Start Embed"):
-            load_files_and_embed(json_paths, pdf_paths, embed=True)
-            clear_memory_and_cache()
+            with start_trace("ingestion", sync=False):
+                load_files_and_embed(json_paths, pdf_paths, embed=True)
+            refresh_knowledge_base()
+            st.write("Done!")
+
+        if st.button("Start Sync"):
+            with start_trace("ingestion", sync=True):
+                load_files_and_embed(json_paths, pdf_paths, embed=True, sync=True)
+            refresh_knowledge_base()
             st.write("Done!")
 
         if st.button("Delete DB"):
-            chroma_server_password = os.getenv("CHROMA_SERVER_AUTHN_CREDENTIALS", "YYYY")
-            chroma_client = chromadb.HttpClient(host=CHROMA_SERVER_HOST, port=CHROMA_SERVER_PORT, settings=Settings(chroma_client_auth_provider="chromadb.auth.token_authn.TokenAuthClientProvider", chroma_client_auth_credentials=chroma_server_password))
-            #chroma_client = chromadb.HttpClient(host=CHROMA_SERVER_HOST, port=CHROMA_SERVER_PORT)
-            vector_db = Chroma(collection_name=CHROMA_COLLECTION_NAME, client=chroma_client)
+            vector_db = get_vector_db()
             vector_db.reset_collection()
-            clear_memory_and_cache()
+            delete_bm25_index()
+            delete_old_local_vector_indexes()  # The reset collection is unversioned, like a previous export
+            refresh_knowledge_base()
             st.write("Done!")
 
+        if st.button("Embedding Cache Info"):
+            st.write(f"Location of the embedding cache: {EMBEDDING_CACHE_PATH}")
+            st.write(get_embedding_model().stats())
+
         if st.button("Restart DB (locally only)"):
             restart_db()
             st.write("Done!")
@@ -381,11 +422,8 @@ if st.session_state.password_ok:
         if st.button("Files and DB Info"):
             load_files_and_embed(json_paths, pdf_paths, embed=False)
             st.write(f"Location of the Chroma vector DB: {CHROMA_SERVER_HOST}:{CHROMA_SERVER_PORT}")
-            #chroma_client = chromadb.HttpClient(host=CHROMA_SERVER_HOST, port=CHROMA_SERVER_PORT)
-            chroma_server_password = os.getenv("CHROMA_SERVER_AUTHN_CREDENTIALS", "YYYY")
-            chroma_client = chromadb.HttpClient(host=CHROMA_SERVER_HOST, port=CHROMA_SERVER_PORT, settings=Settings(chroma_client_auth_provider="chromadb.auth.token_authn.TokenAuthClientProvider", chroma_client_auth_credentials=chroma_server_password))
-            vector_db = Chroma(collection_name=CHROMA_COLLECTION_NAME, client=chroma_client)
-            nbr_embeddings = len(vector_db.get()['documents'])
+            vector_db = get_vector_db()
+            nbr_embeddings = count_collection(vector_db)
             st.write(f"Number of embeddings in the Chroma vector DB: {nbr_embeddings}")
 
             try:
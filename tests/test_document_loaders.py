@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# Ragai - (c) Eric Dodémont, 2024.
+
+"""
+Round trip of the streaming JSON reader (iter_json_items) against json.load, with small chunk sizes
+(the items, numbers included, are cut by the ends of the chunks).
+Run from the root of the repository: python -m pytest tests
+"""
+
+import json
+import random
+
+import pytest
+
+from modules.document_loaders import iter_json_items
+
+
+def random_value(rng: random.Random, depth: int = 0):
+    kind = rng.randrange(7 if depth < 3 else 4)
+    if kind == 0:
+        return rng.randint(-10 ** 6, 10 ** 6)
+    if kind == 1:
+        return rng.choice([rng.uniform(-1e6, 1e6), rng.uniform(-1, 1) * 10 ** rng.randint(-30, 30), 2.5, -0.0])
+    if kind == 2:
+        return "".join(rng.choice("abc é\"\\\n/€👑,]") for _ in range(rng.randint(0, 20)))
+    if kind == 3:
+        return rng.choice([True, False, None])
+    if kind == 4:
+        return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))]
+    return {f"k{i}": random_value(rng, depth + 1) for i in range(rng.randint(0, 4))}
+
+
+def dump(rng: random.Random, items: list) -> str:
+    # Random whitespaces around the items and the separators
+    def space():
+        return rng.choice(["", " ", "\n", "  \r\n\t"])
+    return "[" + space() + ",".join(space() + json.dumps(item, ensure_ascii=rng.random() < 0.5) + space() for item in items) + space() + "]"
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 8, 64, 256])
+def test_round_trip(tmp_path, chunk_size):
+    rng = random.Random(chunk_size)
+    path = tmp_path / "items.json"
+    for _ in range(100):
+        items = [random_value(rng) for _ in range(rng.randint(0, 30))]
+        path.write_text(dump(rng, items), encoding="utf-8")
+        with open(path, "r", encoding="utf-8") as f:
+            expected = json.load(f)
+        assert list(iter_json_items(str(path), chunk_size=chunk_size)) == expected
+
+
+@pytest.mark.parametrize("text", ["[2.5, 10e3, -7]", "[1, 2.75]", "[123456789]"])
+def test_numbers_cut_by_the_chunks(tmp_path, text):
+    path = tmp_path / "numbers.json"
+    path.write_text(text, encoding="utf-8")
+    for chunk_size in range(1, len(text) + 1):
+        assert list(iter_json_items(str(path), chunk_size=chunk_size)) == json.loads(text)
+
+
+def test_object(tmp_path):
+    path = tmp_path / "object.json"
+    path.write_text('{"a": {"url": "x"}, "b": 2.5}', encoding="utf-8")
+    assert list(iter_json_items(str(path), chunk_size=4)) == [{"url": "x"}, 2.5]
+
+
+@pytest.mark.parametrize("text", ["[1 2]", "[1,", '[{"a": 1}'])
+def test_invalid(tmp_path, text):
+    path = tmp_path / "invalid.json"
+    path.write_text(text, encoding="utf-8")
+    with pytest.raises(ValueError):
+        list(iter_json_items(str(path), chunk_size=2))